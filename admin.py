@@ -2,147 +2,260 @@ import streamlit as st
 import database
 import pandas as pd
 import plotly.express as px
-import time
-from datetime import datetime, timedelta
+import re
+import utils
+import profiling
+import export
+import charts
+
+REFRESH_INTERVAL = 5  # seconds between change checks
+
+@st.fragment(run_every=REFRESH_INTERVAL)
+def watch_for_changes():
+    # Only this fragment runs on the timer; it reruns the whole page when the
+    # trigger-maintained data versions move, so idle tabs cost no queries.
+    if database.data_versions() != st.session_state.get('admin_data_versions'):
+        st.rerun()
+
+ORDERS_PAGE_SIZE = 50
+
+def cached_admin_query(name, key, func):
+    # Reuse a result while its inputs and the data versions are unchanged.
+    # Fallback versions may count uncommitted writes, so don't cache on them.
+    if not st.session_state.admin_versions_cacheable:
+        return func()
+    cache = st.session_state.setdefault('admin_query_cache', {})
+    key = (key, tuple(sorted(st.session_state.admin_data_versions.items())))
+    if name not in cache or cache[name][0] != key:
+        cache[name] = (key, func())
+    return cache[name][1]
+
+def parse_order_ids(text):
+    # Order IDs pasted from a spreadsheet or CSV column
+    order_ids = []
+    for token in re.split(r'[\s,;]+', text.strip()):
+        if not token:
+            continue
+        if not token.lstrip('#').isdigit():
+            raise ValueError(f"Not an order ID: {token}")
+        order_ids.append(int(token.lstrip('#')))
+    return order_ids
+
+def discard_export():
+    st.session_state.pop('orders_export', None)
+
+# Reads that don't depend on the filters; they run in parallel
+DASHBOARD_READS = {
+    'filter_bounds': database.order_filter_bounds,
+    'orders_by_status': database.orders_by_status,
+    'daily_counts': database.daily_counts,
+    'daily_revenue': database.daily_revenue,
+    'top_customers': lambda: database.top_customers(10),
+    'first_time_customer_count': database.count_first_time_customers,
+    'first_time_orders': database.fetch_first_time_customer_orders,
+}
+
+def load_dashboard_data():
+    return cached_admin_query('dashboard_data', None, lambda: dict(zip(
+        DASHBOARD_READS, database.call_concurrently(list(DASHBOARD_READS.values()))
+    )))
 
 def admin_dashboard():
     st.title("Wash & Go Delivery Admin Dashboard 🚀")
     
-    st.write("This dashboard updates automatically every 5 seconds.")
-    
-    placeholder = st.empty()
-    
-    while True:
-        with placeholder.container():
-            # Display all orders
-            st.header("All Orders")
-            orders = database.fetch_all("SELECT * FROM orders")
-            df_orders = pd.DataFrame(orders, columns=['id', 'user_id', 'pickup_date', 'pickup_time', 'location', 'status', 'weight', 'item_count', 'total_price'])
-            
-            # Add filters
-            st.subheader("Filters")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                status_filter = st.multiselect("Status", df_orders['status'].unique())
-            with col2:
-                date_range = st.date_input("Date Range", [df_orders['pickup_date'].min(), df_orders['pickup_date'].max()])
-            with col3:
-                price_range = st.slider("Price Range", float(df_orders['total_price'].min()), float(df_orders['total_price'].max()), (float(df_orders['total_price'].min()), float(df_orders['total_price'].max())))
-            
-            # Apply filters
-            filtered_df = df_orders[
-                (df_orders['status'].isin(status_filter) if status_filter else True) &
-                (df_orders['pickup_date'].between(date_range[0], date_range[1])) &
-                (df_orders['total_price'].between(price_range[0], price_range[1]))
-            ]
-            
-            st.dataframe(filtered_df.style.highlight_max(axis=0))
-            
-            # Update order status
-            st.subheader("Update Order Status")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                order_id = st.number_input("Order ID", min_value=1, step=1)
-            with col2:
-                new_status = st.selectbox("New Status", ["Pending", "Picked Up", "In Progress", "Ready for Delivery", "Delivered", "Cancelled"])
-            with col3:
-                if st.button("Update Status"):
-                    database.execute_query("UPDATE orders SET status = %s WHERE id = %s", (new_status, order_id))
-                    st.success(f"Order {order_id} status updated to {new_status}")
-            
-            # Visualizations
-            st.header("Wash & Go Delivery Order Statistics")
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                # Orders by status
-                status_counts = df_orders['status'].value_counts()
-                fig_status = px.pie(values=status_counts.values, names=status_counts.index, title="Orders by Status")
-                st.plotly_chart(fig_status)
-            
-            with col2:
-                # Daily order count
-                df_orders['pickup_date'] = pd.to_datetime(df_orders['pickup_date'])
-                daily_orders = df_orders.groupby('pickup_date').size().reset_index(name='count')
-                fig_daily = px.line(daily_orders, x='pickup_date', y='count', title="Daily Order Count")
-                st.plotly_chart(fig_daily)
-            
-            # Revenue analysis
-            st.subheader("Wash & Go Delivery Revenue Analysis")
-            df_orders['pickup_date'] = pd.to_datetime(df_orders['pickup_date'])
-            revenue_by_date = df_orders.groupby('pickup_date')['total_price'].sum().reset_index()
-            fig_revenue = px.bar(revenue_by_date, x='pickup_date', y='total_price', title="Daily Revenue")
-            st.plotly_chart(fig_revenue)
-            
-            # Top customers
-            st.subheader("Top Wash & Go Delivery Customers")
-            top_customers = df_orders.groupby('user_id')['total_price'].sum().sort_values(ascending=False).head(10).reset_index()
-            fig_top_customers = px.bar(top_customers, x='user_id', y='total_price', title="Top 10 Customers by Revenue")
-            st.plotly_chart(fig_top_customers)
-            
-            # First-time customer analysis
-            st.subheader("Wash & Go Delivery First-Time Customer Analysis")
-            first_time_customers = database.fetch_all("SELECT * FROM users WHERE is_first_time_customer = TRUE")
-            st.write(f"Number of first-time customers: {len(first_time_customers)}")
-            
-            first_time_orders = database.fetch_all("""
-                SELECT o.* FROM orders o
-                JOIN users u ON o.user_id = u.id
-                WHERE u.is_first_time_customer = TRUE
-            """)
-            df_first_time_orders = pd.DataFrame(first_time_orders, columns=['id', 'user_id', 'pickup_date', 'pickup_time', 'location', 'status', 'weight', 'item_count', 'total_price'])
-            
-            if not df_first_time_orders.empty:
-                st.write("First-Time Customer Orders:")
-                st.dataframe(df_first_time_orders)
-                
-                # Calculate total discount given to first-time customers
-                total_discount = df_first_time_orders['total_price'].sum() * 0.25  # 20% discount is equivalent to 25% of the discounted price
-                st.write(f"Total discount given to first-time customers: ${total_discount:.2f}")
+    st.write("This dashboard refreshes automatically when orders or customers change.")
+    
+    st.session_state.admin_versions_cacheable = database.data_versions_cacheable()
+    st.session_state.admin_data_versions = database.data_versions()
+    watch_for_changes()
+    
+    data = load_dashboard_data()
+    
+    # Display all orders
+    st.header("All Orders")
+    min_date, max_date, min_price, max_price = data['filter_bounds']
+    min_price, max_price = float(min_price or 0), float(max_price or 0)
+    
+    # Add filters
+    st.subheader("Filters")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        status_filter = st.multiselect("Status", database.ORDER_STATUSES)
+    with col2:
+        date_range = st.date_input("Date Range", [min_date, max_date] if min_date else [])
+    with col3:
+        price_range = st.slider("Price Range", min_price, max_price, (min_price, max_price))
+    
+    # Filters are applied in SQL and only the selected page is fetched
+    filters = {
+        'statuses': status_filter,
+        'date_range': tuple(date_range) if len(date_range) == 2 else None,
+        # The full slider range filters nothing, so leave it out of the SQL
+        'price_range': None if price_range == (min_price, max_price) else price_range,
+    }
+    filter_key = repr(filters)
+    # New filters start from the first page; a page past the end, e.g. after
+    # the count shrank, is clamped below and applied here on the rerun
+    page_clamp = st.session_state.pop('orders_page_clamp', None)
+    if st.session_state.get('orders_filter_key') != filter_key:
+        st.session_state.orders_filter_key = filter_key
+        st.session_state.orders_page = 1
+    elif page_clamp:
+        st.session_state.orders_page = page_clamp
+    page = st.number_input("Page", min_value=1, step=1, key='orders_page')
+    total_orders, filtered_df = cached_admin_query('orders_page', (filter_key, page), lambda: database.call_concurrently([
+        lambda: database.count_orders_filtered(filters),
+        lambda: database.fetch_orders_filtered(filters, limit=ORDERS_PAGE_SIZE, offset=(page - 1) * ORDERS_PAGE_SIZE),
+    ]))
+    page_count = max(1, -(-total_orders // ORDERS_PAGE_SIZE))
+    if page > page_count:
+        st.session_state.orders_page_clamp = page_count
+        st.rerun()
+    st.write(f"{total_orders} matching orders, page {page} of {page_count}")
+    st.dataframe(filtered_df.style.highlight_max(axis=0).format({'total_price': '${:.2f}', 'weight': '{:.1f}'}))
+    
+    # Export every order matching the status and date filters, not just this page
+    with st.expander("Export Orders"):
+        export_format = st.selectbox("Format", export.EXPORT_FORMATS, format_func=str.upper)
+        if st.button("Prepare Export"):
+            discard_export()
+            data, count = export.export_to_bytes(export_format, statuses=status_filter, date_range=filters['date_range'])
+            st.session_state.orders_export = (data, export_format, export.export_file_name(export_format, filters['date_range']), count)
+        # Offered until it is downloaded once
+        if 'orders_export' in st.session_state:
+            data, prepared_format, file_name, count = st.session_state.orders_export
+            st.download_button(f"Download {count} orders", data, file_name=file_name,
+                               mime=export.MIME_TYPES[prepared_format], on_click=discard_export)
+    
+    # Update order status for any number of orders at once
+    st.subheader("Update Order Status")
+    col1, col2 = st.columns(2)
+    with col1:
+        selected_ids = st.multiselect("Orders on this page", filtered_df['id'].tolist(), format_func=lambda order_id: f"#{order_id}")
+        pasted_ids = st.text_area("Order IDs", placeholder="Paste IDs separated by commas, spaces or new lines")
+    with col2:
+        new_status = st.selectbox("New Status", database.ORDER_STATUSES)
+        if st.button("Update Status"):
+            try:
+                order_ids = set(selected_ids) | set(parse_order_ids(pasted_ids))
+            except ValueError as e:
+                st.error(str(e))
             else:
-                st.write("No orders from first-time customers yet.")
-            
-            # Real-time order tracking
-            st.subheader("Wash & Go Delivery Real-Time Order Tracking")
-            for _, order in filtered_df.iterrows():
-                with st.expander(f"Order #{order['id']} - {order['pickup_date']}"):
-                    st.write(f"Status: {order['status']}")
-                    st.write(f"Total Price: ${order['total_price']:.2f}")
-                    st.write(f"Pickup Time: {order['pickup_time']}")
-                    st.write(f"Location: {order['location']}")
-                    
-                    # Add a progress bar for order status
-                    progress = get_order_progress(order['status'])
-                    st.progress(progress)
-                    
-                    # Add estimated delivery time
-                    estimated_delivery = get_estimated_delivery(order['pickup_date'], order['status'])
-                    st.write(f"Estimated Delivery: {estimated_delivery}")
-                    
-                    # Add a map showing the order location (placeholder)
-                    st.write("Order Location:")
-                    st.map()  # This will show a default map. In a real app, we'd use the actual coordinates.
+                if not order_ids:
+                    st.warning("Select or paste at least one order ID")
+                else:
+                    updated, skipped = database.transition_orders(order_ids, new_status, changed_by=st.session_state.user['id'])
+                    if updated:
+                        st.success(f"{len(updated)} order(s) updated to {new_status}")
+                    if skipped:
+                        st.warning("Not updated: " + ", ".join(
+                            f"#{order_id} (not found)" if status is None else f"#{order_id} ({status})"
+                            for order_id, status in sorted(skipped.items())
+                        ))
+    
+    # Visualizations, shared with other admin sessions until orders change
+    st.header("Wash & Go Delivery Order Statistics")
+    # No version means the figures are drawn fresh rather than shared
+    orders_version = st.session_state.admin_data_versions.get('orders') if st.session_state.admin_versions_cacheable else None
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        # Orders by status
+        fig_status = charts.cached_figure('admin_orders_by_status', None, orders_version, lambda: px.pie(
+            data['orders_by_status'], values='count', names='status', title="Orders by Status"
+        ))
+        st.plotly_chart(fig_status)
+    
+    with col2:
+        # Daily order count
+        fig_daily = charts.cached_figure('admin_daily_counts', None, orders_version, lambda: px.line(
+            data['daily_counts'], x='pickup_date', y='count', title="Daily Order Count"
+        ))
+        st.plotly_chart(fig_daily)
+    
+    # Revenue analysis
+    st.subheader("Wash & Go Delivery Revenue Analysis")
+    fig_revenue = charts.cached_figure('admin_daily_revenue', None, orders_version, lambda: px.bar(
+        data['daily_revenue'], x='pickup_date', y='total_price', title="Daily Revenue"
+    ))
+    st.plotly_chart(fig_revenue)
+    
+    # Top customers
+    st.subheader("Top Wash & Go Delivery Customers")
+    fig_top_customers = charts.cached_figure('admin_top_customers', 10, orders_version, lambda: px.bar(
+        data['top_customers'], x='user_id', y='total_price', title="Top 10 Customers by Revenue"
+    ))
+    st.plotly_chart(fig_top_customers)
+    
+    # First-time customer analysis
+    st.subheader("Wash & Go Delivery First-Time Customer Analysis")
+    first_time_customer_count = data['first_time_customer_count']
+    st.write(f"Number of first-time customers: {first_time_customer_count}")
+    
+    df_first_time_orders = data['first_time_orders']
+    
+    if not df_first_time_orders.empty:
+        st.write("First-Time Customer Orders:")
+        st.dataframe(df_first_time_orders, column_config={'total_price': st.column_config.NumberColumn("Total Price", format="$%.2f")})
         
-        time.sleep(5)
-        st.rerun()
+        # Re-quote the orders at full and discounted price to find the discount given
+        total_discount = utils.first_time_discounts(df_first_time_orders['weight'].fillna(0).to_numpy()).sum()
+        st.write(f"Total discount given to first-time customers: ${total_discount:.2f}")
+    else:
+        st.write("No orders from first-time customers yet.")
+    
+    # Real-time order tracking
+    st.subheader("Wash & Go Delivery Real-Time Order Tracking")
+    if filtered_df.empty:
+        st.write("No orders match the current filters.")
+    else:
+        with profiling.span('pandas'):
+            tracking = build_tracking_frame(filtered_df)
+        st.dataframe(
+            tracking[['id', 'pickup_date', 'pickup_time', 'status', 'progress', 'estimated_delivery', 'total_price', 'location']],
+            hide_index=True,
+            column_config={
+                'pickup_date': st.column_config.DateColumn("Pickup Date"),
+                'progress': st.column_config.ProgressColumn("Progress", min_value=0, max_value=100, format="%d%%"),
+                'total_price': st.column_config.NumberColumn("Total Price", format="$%.2f"),
+            },
+        )
+        
+        # One map layer for every order on the page that falls in a service area
+        st.write("Order Locations:")
+        st.map(tracking.dropna(subset=['lat', 'lon']), latitude='lat', longitude='lon')
+        
+        # Detail for a single selected order only
+        selected_id = st.selectbox("Order details", [None] + tracking['id'].tolist(),
+                                   format_func=lambda order_id: "Select an order" if order_id is None else f"Order #{order_id}")
+        if selected_id is not None:
+            order = tracking[tracking['id'] == selected_id].iloc[0]
+            st.write(f"Status: {order['status']}")
+            st.write(f"Total Price: ${order['total_price']:.2f}")
+            st.write(f"Pickup Time: {order['pickup_time']}")
+            st.write(f"Location: {order['location']}")
+            st.progress(int(order['progress']))
+            st.write(f"Estimated Delivery: {order['estimated_delivery']}")
 
-def get_order_progress(status):
-    status_progress = {
-        "Pending": 0,
-        "Picked Up": 25,
-        "In Progress": 50,
-        "Ready for Delivery": 75,
-        "Delivered": 100
-    }
-    return status_progress.get(status, 0)
+STATUS_PROGRESS = {
+    "Pending": 0,
+    "Picked Up": 25,
+    "In Progress": 50,
+    "Ready for Delivery": 75,
+    "Delivered": 100
+}
 
-def get_estimated_delivery(pickup_date, status):
-    pickup_date = datetime.strptime(str(pickup_date), "%Y-%m-%d")
-    if status == "Delivered":
-        return "Order has been delivered"
-    elif status == "Ready for Delivery":
-        return "Today"
-    else:
-        estimated_date = pickup_date + timedelta(days=2)
-        return estimated_date.strftime("%Y-%m-%d")
+def build_tracking_frame(orders_df):
+    # Progress and estimated delivery for each order, plus coordinates looked
+    # up from the service area named in each address
+    tracking = orders_df.copy()
+    tracking['progress'] = tracking['status'].astype(str).map(STATUS_PROGRESS).fillna(0).astype(int)
+    estimated = (tracking['pickup_date'] + pd.Timedelta(days=2)).dt.strftime("%Y-%m-%d")
+    estimated = estimated.mask(tracking['status'] == "Ready for Delivery", "Today")
+    tracking['estimated_delivery'] = estimated.mask(tracking['status'] == "Delivered", "Order has been delivered")
+    cities = tracking['location'].str.extract(utils.SERVICE_AREA_PATTERN, flags=re.IGNORECASE, expand=False).str.lower()
+    city_coordinates = {area.split(',')[0].lower(): coords for area, coords in utils.SERVICE_AREAS.items()}
+    tracking['lat'] = cities.map({city: coords[0] for city, coords in city_coordinates.items()})
+    tracking['lon'] = cities.map({city: coords[1] for city, coords in city_coordinates.items()})
+    return tracking
@@ -2,6 +2,7 @@ import streamlit as st
 import database
 import hashlib
 import re
+import psycopg2.errors
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -13,17 +14,17 @@ def login_page():
     
     if st.button("Login"):
         print("Login button clicked")  # Debug print
-        user = database.fetch_one("SELECT * FROM users WHERE username = %s", (username,))
+        user = database.find_user_by_username(username)
         print(f"User query result: {user}")  # Debug print
-        if user and user[2] == hash_password(password):
+        if user and user['password'] == hash_password(password):
             print("Login successful")  # Debug print
             st.session_state.user = {
-                'id': user[0],
-                'username': user[1],
-                'email': user[3],
-                'phone': user[4],
-                'is_admin': user[5],
-                'is_first_time_customer': user[6] if len(user) > 6 else True  # Default to True if field doesn't exist
+                'id': user['id'],
+                'username': user['username'],
+                'email': user['email'],
+                'phone': user['phone'],
+                'is_admin': user['is_admin'],
+                'is_first_time_customer': user['is_first_time_customer']
             }
             st.session_state.page = "User Dashboard"  # Set the page to User Dashboard after successful login
             st.success("Logged in successfully!")
@@ -43,25 +44,22 @@ def register_page():
     if st.button("Register"):
         if password != confirm_password:
             st.error("Passwords do not match")
-        elif database.fetch_one("SELECT * FROM users WHERE username = %s", (username,)):
-            st.error("Username already exists")
         elif not validate_email(email):
             st.error("Invalid email address")
         elif not validate_phone(phone):
             st.error("Invalid phone number")
         else:
-            hashed_password = hash_password(password)
-            database.execute_query('INSERT INTO users (username, password, email, phone) VALUES (%s, %s, %s, %s)', (username, hashed_password, email, phone))
-            user_id = database.fetch_one('SELECT id FROM users WHERE username = %s', (username,))[0]
+            # The insert reports a taken username itself, so there is no separate lookup
+            try:
+                user = database.register_user(username, hash_password(password), email, phone)
+            except psycopg2.errors.UniqueViolation:
+                st.error("Email address is already registered")
+                return
+            if user is None:
+                st.error("Username already exists")
+                return
             
-            st.session_state.user = {
-                'id': user_id,
-                'username': username,
-                'email': email,
-                'phone': phone,
-                'is_admin': False,
-                'is_first_time_customer': True
-            }
+            st.session_state.user = dict(user)
             st.success("Registration successful! Redirecting to dashboard...")
             st.rerun()
 
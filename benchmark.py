@@ -0,0 +1,194 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import uuid
+from datetime import date, time as time_of_day, timedelta
+import numpy as np
+import database
+import synthetic_data
+import utils
+
+# Times the data paths behind the main pages against synthetic datasets in a
+# throwaway database, writes the results as JSON and compares them with a
+# stored baseline. Runs offline against a local Postgres only.
+
+SCALES = {
+    '10k': (1_000, 10_000),
+    '1m': (100_000, 1_000_000),
+    '10m': (1_000_000, 10_000_000),
+}
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# Ignore differences smaller than this; they are noise at these latencies
+NOISE_FLOOR_MS = 1.0
+
+def _order_history_path(user_id):
+    first_page, _, _ = database.call_concurrently([
+        lambda: database.fetch_user_orders_page(user_id, limit=21),
+        lambda: database.user_orders_by_status(user_id),
+        lambda: database.user_spending_by_date(user_id),
+    ])
+    if len(first_page) > 20:
+        last = first_page[19]
+        database.fetch_user_orders_page(user_id, after=(last[2], last[0]), limit=21)
+
+def _admin_dashboard_path():
+    filters = {'statuses': [], 'date_range': None, 'price_range': None}
+    # Same two concurrent batches as admin.admin_dashboard
+    database.call_concurrently([
+        database.order_filter_bounds,
+        database.orders_by_status,
+        database.daily_counts,
+        database.daily_revenue,
+        lambda: database.top_customers(10),
+        database.count_first_time_customers,
+        database.fetch_first_time_customer_orders,
+    ])
+    database.call_concurrently([
+        lambda: database.count_orders_filtered(filters),
+        lambda: database.fetch_orders_filtered(filters, limit=50),
+    ])
+
+def _admin_filtered_path():
+    # One day's pending orders, the most common admin filter
+    filters = {'statuses': ['Pending'], 'date_range': (date.today(), date.today()), 'price_range': None}
+    database.count_orders_filtered(filters)
+    database.fetch_orders_filtered(filters, limit=50)
+
+BENCHMARK_SERVICE_AREA = next(iter(utils.SERVICE_AREAS))
+
+def _payment_path(user_id):
+    # The database side of checkout: save the pending order, record its
+    # session and finalize it, as the payment pipeline does around Stripe
+    order = {
+        'user_id': user_id,
+        'service_area': BENCHMARK_SERVICE_AREA,
+        'pickup_date': date.today() + timedelta(days=1),
+        'pickup_time': time_of_day(9, 0),
+        'location': synthetic_data.LOCATIONS[0],
+        'weight': 10.0,
+        'item_count': 5,
+        'total_price': 41.9,
+    }
+    pending_id, _ = database.create_pending_order(order, str(uuid.uuid4()))
+    checkout_session_id = f'cs_benchmark_{pending_id}'
+    database.mark_checkout_open(pending_id, checkout_session_id, 'https://checkout.invalid/', 1)
+    database.finalize_paid_checkouts([checkout_session_id])
+
+def benchmark_cases(heavy_user, typical_user, first_time_user, orders_per_year):
+    rng = np.random.default_rng(0)
+    year_weights = rng.uniform(3, 25, orders_per_year)
+    year_first_time = rng.random(orders_per_year) < 0.08
+    # Enough room in the checkout's pickup slot that no iteration finds it full
+    database.ensure_slots(BENCHMARK_SERVICE_AREA, date.today() + timedelta(days=1), [time_of_day(9, 0)], capacity=2**31 - 1)
+    return {
+        'login_lookup': lambda: database.find_user_by_username(f'user{typical_user}'),
+        'user_dashboard_heavy_customer': lambda: database.fetch_recent_orders(heavy_user),
+        'user_dashboard_typical_customer': lambda: database.fetch_recent_orders(typical_user),
+        'order_history_heavy_customer': lambda: _order_history_path(heavy_user),
+        'order_history_typical_customer': lambda: _order_history_path(typical_user),
+        'admin_dashboard': _admin_dashboard_path,
+        'admin_filtered_orders': _admin_filtered_path,
+        'handle_successful_payment': lambda: _payment_path(first_time_user),
+        'reprice_one_year': lambda: utils.calculate_total_prices(year_weights, is_first_time_customer=year_first_time),
+    }
+
+def time_case(func, iterations, warmup):
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': statistics.median(samples),
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'mean_ms': statistics.fmean(samples),
+        'min_ms': samples[0],
+    }
+
+def run_scale(name, iterations, warmup, seed, database_name):
+    n_users, n_orders = SCALES[name]
+    synthetic_data.create_scratch_database(database_name)
+    try:
+        load_start = time.perf_counter()
+        synthetic_data.load(n_users, n_orders, seed=seed)
+        load_seconds = time.perf_counter() - load_start
+        # User 1 has the most orders; the last user never ordered
+        typical_user = max(2, n_users // 10)
+        # synthetic_data spreads orders over three years by default
+        cases = benchmark_cases(heavy_user=1, typical_user=typical_user, first_time_user=n_users, orders_per_year=n_orders // 3)
+        results = {}
+        for case, func in cases.items():
+            results[case] = time_case(func, iterations, warmup)
+            print(f"  {name:>4} {case:<34} p50 {results[case]['p50_ms']:9.2f} ms  p95 {results[case]['p95_ms']:9.2f} ms")
+        return {'users': n_users, 'orders': n_orders, 'load_seconds': load_seconds, 'cases': results}
+    finally:
+        synthetic_data.drop_scratch_database(database_name)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        baseline_cases = baseline.get('scales', {}).get(scale, {}).get('cases', {})
+        for case, stats in scale_results['cases'].items():
+            if case not in baseline_cases:
+                continue
+            before = baseline_cases[case]['p50_ms']
+            after = stats['p50_ms']
+            if after > before * (1 + tolerance) and after - before > NOISE_FLOOR_MS:
+                regressions.append(f"{scale}/{case}: p50 {before:.2f} ms -> {after:.2f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark page data paths on synthetic data")
+    parser.add_argument('--scales', default='10k', help=f"Comma-separated subset of {', '.join(SCALES)}")
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', default=synthetic_data.SCRATCH_DATABASE)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed p50 slowdown as a fraction of the baseline")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
+    args = parser.parse_args()
+
+    scales = [scale.strip() for scale in args.scales.split(',') if scale.strip()]
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error(f"Unknown scale(s): {', '.join(unknown)}")
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'scales': {scale: run_scale(scale, args.iterations, args.warmup, args.seed, args.database) for scale in scales},
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Updated baseline {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one")
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import metrics
+import profiling
+from cache import TTLCache
+
+# Plotly figures shared across reruns and sessions. Each figure is stored
+# under its name, the parameters it was drawn with and the version of the
+# data behind it; storing a newer version drops the older ones, so a changed
+# order replaces the figure instead of leaving it to age out. Cached figures
+# are shared, so callers must not modify them.
+
+FIGURE_CACHE_SIZE = int(os.environ.get('FIGURE_CACHE_SIZE', 512))
+FIGURE_CACHE_TTL = float(os.environ.get('FIGURE_CACHE_TTL', 3600))
+
+_figures = TTLCache(maxsize=FIGURE_CACHE_SIZE, ttl=FIGURE_CACHE_TTL)
+metrics.registry.register_gauge('washgo_figure_cache', _figures.stats)
+
+def cached_figure(name, params, version, build):
+    # build() draws the figure and is only called on a miss. A version of
+    # None means the data's version isn't trustworthy; the figure is drawn
+    # and not cached.
+    if version is None:
+        with profiling.span('plotly'):
+            return build()
+    key = (name, params, version)
+    figure = _figures.get(key)
+    if figure is None:
+        with profiling.span('plotly'):
+            figure = build()
+        _figures.discard_where(lambda cached: cached[:2] == (name, params) and cached[2] != version)
+        _figures.set(key, figure)
+    return figure
+
+def clear():
+    _figures.clear()
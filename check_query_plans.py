@@ -0,0 +1,81 @@
+import argparse
+import sys
+from datetime import date, timedelta
+import database
+import synthetic_data
+
+# Runs EXPLAIN on the hot page queries against a large synthetic dataset and
+# fails if any of them falls back to a sequential scan on a large table.
+
+# Sample parameters for the checks
+SAMPLE_USER = 42
+NO_FILTERS = {'statuses': [], 'date_range': None, 'price_range': None}
+STATUS_FILTER = {**NO_FILTERS, 'statuses': ['Pending']}
+LAST_WEEK = (date.today() - timedelta(days=7), date.today())
+DATE_FILTER = {**NO_FILTERS, 'date_range': LAST_WEEK}
+
+# Each check returns the plan of a query exactly as the pages build it, so
+# the checks follow the code instead of copies of its SQL
+HOT_QUERIES = {
+    'login lookup': lambda: database.explain_prepared('find_user_by_username', ('user42',)),
+    'user_dashboard recent orders': lambda: database.explain_prepared('fetch_recent_orders', (SAMPLE_USER, 5)),
+    'order_history first page': lambda: database.explain(*database.user_orders_page_query(SAMPLE_USER, None, 21)),
+    'order_history next page': lambda: database.explain(*database.user_orders_page_query(SAMPLE_USER, (date.today(), 2**31 - 1), 21)),
+    'order_history status breakdown': lambda: database.explain(database.USER_ORDERS_BY_STATUS_QUERY, (SAMPLE_USER,)),
+    'order_history spending by date': lambda: database.explain(database.USER_SPENDING_BY_DATE_QUERY, (SAMPLE_USER,)),
+    'admin grid': lambda: database.explain(*database.orders_page_query(NO_FILTERS)),
+    'admin grid later page': lambda: database.explain(*database.orders_page_query(NO_FILTERS, offset=500)),
+    'admin grid status filter': lambda: database.explain(*database.orders_page_query(STATUS_FILTER)),
+    'admin grid date range filter': lambda: database.explain(*database.orders_page_query(DATE_FILTER)),
+    'admin count': lambda: database.explain(*database.count_orders_query(NO_FILTERS)),
+    'admin count status filter': lambda: database.explain(*database.count_orders_query(STATUS_FILTER)),
+    'admin count date range filter': lambda: database.explain(*database.count_orders_query(DATE_FILTER)),
+    'admin filter bounds': lambda: database.explain(database.ORDER_FILTER_BOUNDS_QUERY),
+    'admin orders by status': lambda: database.explain(database.ORDERS_BY_STATUS_QUERY),
+    'admin daily counts': lambda: database.explain(*database.daily_counts_query()),
+    'admin daily revenue': lambda: database.explain(*database.daily_revenue_query(LAST_WEEK)),
+    'admin top customers': lambda: database.explain(*database.top_customers_query(10)),
+    'admin first-time customer orders': lambda: database.explain(database.FIRST_TIME_CUSTOMER_ORDERS_QUERY),
+}
+
+# The rollups are small per day but customer_revenue_rollup grows with users
+CHECKED_TABLES = {'orders', 'users', 'customer_revenue_rollup'}
+
+def find_seq_scans(plan):
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in CHECKED_TABLES:
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        scans.extend(find_seq_scans(child))
+    return scans
+
+def check_plans():
+    failures = []
+    for name, plan in HOT_QUERIES.items():
+        scans = find_seq_scans(plan())
+        if scans:
+            failures.append(name)
+            print(f"FAIL {name}: sequential scan on {', '.join(scans)}")
+        else:
+            print(f"ok   {name}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Check hot queries for sequential scans")
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--orders', type=int, default=500_000)
+    parser.add_argument('--database', default=synthetic_data.SCRATCH_DATABASE)
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch database afterwards")
+    args = parser.parse_args()
+
+    synthetic_data.create_scratch_database(args.database)
+    try:
+        synthetic_data.load(args.users, args.orders)
+        failures = check_plans()
+    finally:
+        if not args.keep:
+            synthetic_data.drop_scratch_database(args.database)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,26 @@
 import os
+import atexit
+import contextvars
+import csv
+import functools
+import io
+import itertools
+import select
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import pandas as pd
 import psycopg2
+import psycopg2.errors
 from psycopg2 import sql
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
 import streamlit as st
+import metrics
+import profiling
+from cache import TTLCache
 
 # Database connection parameters
 db_params = {
@@ -12,143 +31,1376 @@ db_params = {
     'port': os.environ.get('PGPORT')
 }
 
-def get_db_connection():
-    return psycopg2.connect(**db_params)
+# Connection pool settings
+pool_settings = {
+    'minconn': int(os.environ.get('DB_POOL_MIN', 1)),
+    'maxconn': int(os.environ.get('DB_POOL_MAX', 10)),
+    'idle_timeout': float(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300)),
+    'checkout_timeout': float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 30)),
+    'ping_after': float(os.environ.get('DB_POOL_PING_AFTER', 30)),
+}
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    try:
-        # Create sequence for users table if it doesn't exist
-        cur.execute('''
-        DO $$
-        BEGIN
-            IF NOT EXISTS (SELECT 1 FROM pg_sequences WHERE schemaname = 'public' AND sequencename = 'users_id_seq') THEN
-                CREATE SEQUENCE users_id_seq START 1;
-            END IF;
-        END
-        $$;
-        ''')
-
-        # Create new users table without loyalty points and referral code
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY DEFAULT nextval('users_id_seq'),
-            username VARCHAR(50) UNIQUE NOT NULL,
-            password VARCHAR(100) NOT NULL,
-            email VARCHAR(100) UNIQUE NOT NULL,
-            phone VARCHAR(20) NOT NULL,
-            is_admin BOOLEAN DEFAULT FALSE,
-            is_first_time_customer BOOLEAN DEFAULT TRUE
-        )
-        """)
-        
-        # Check if users_old table exists
-        cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'users_old')")
-        users_old_exists = cur.fetchone()[0]
-
-        if users_old_exists:
-            # Check if email and phone columns exist in users_old table
-            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users_old' AND column_name IN ('email', 'phone')")
-            existing_columns = [row[0] for row in cur.fetchall()]
-
-            # Modify the INSERT statement based on existing columns
-            if 'email' in existing_columns and 'phone' in existing_columns:
-                insert_query = '''
-                INSERT INTO users (id, username, password, email, phone, is_admin)
-                SELECT id, username, password, 
-                    COALESCE(email, username || '@example.com') as email,
-                    COALESCE(phone, '1234567890') as phone,
-                    is_admin 
-                FROM users_old
-                ON CONFLICT (id) DO NOTHING
-                '''
+class ConnectionPool:
+    # Thread-safe pool shared by every Streamlit session in the process.
+    # Connections idle for longer than idle_timeout are closed down to minconn,
+    # and a connection that sat unused for ping_after seconds is checked with
+    # a round trip before it is handed out again. Connections run in
+    # autocommit, so a single statement costs one round trip.
+    def __init__(self, minconn, maxconn, idle_timeout=300, checkout_timeout=30, ping_after=30, **conn_params):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: minconn=%s maxconn=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self.conn_params = conn_params
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._size = 0   # idle + checked out connections
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.conn_params)
+        conn.autocommit = True
+        return conn
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _evict_idle(self):
+        # Called with the lock held; the oldest connections sit at the front.
+        now = time.monotonic()
+        while self._idle and self._size > self.minconn and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._close_quietly(conn)
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise pg_pool.PoolError("connection pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise pg_pool.PoolError("timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+        if conn is not None and self._is_alive(conn, last_used):
+            return conn
+        if conn is not None:
+            self._close_quietly(conn)
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
             else:
-                insert_query = '''
-                INSERT INTO users (id, username, password, email, phone, is_admin)
-                SELECT id, username, password, 
-                    username || '@example.com' as email,
-                    '1234567890' as phone,
-                    is_admin 
-                FROM users_old
-                ON CONFLICT (id) DO NOTHING
-                '''
-
-            cur.execute(insert_query)
-
-            # Now we can safely drop the users_old table
-            cur.execute("DROP TABLE IF EXISTS users_old")
-
-        # Update the sequence to the maximum ID
-        cur.execute('''
-        SELECT setval('users_id_seq', COALESCE((SELECT MAX(id) FROM users), 0) + 1, false);
-        ''')
-        
-        # Create orders table (unchanged)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            pickup_date DATE NOT NULL,
-            pickup_time TIME NOT NULL,
-            location TEXT NOT NULL,
-            status VARCHAR(20) DEFAULT 'Pending',
-            weight FLOAT,
-            item_count INTEGER,
-            total_price FLOAT
-        )
-        """)
+                try:
+                    if status != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    # Undo a borrower turning autocommit off for a transaction
+                    conn.autocommit = True
+                except psycopg2.Error:
+                    discard = True
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
 
-        # Drop the referrals table if it exists
-        cur.execute("DROP TABLE IF EXISTS referrals")
-        
-        conn.commit()
-    except psycopg2.Error as e:
-        conn.rollback()
-        print(f"An error occurred: {e}")
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle), 'maxconn': self.maxconn}
+
+class PreparingConnection(extensions.connection):
+    # Tracks which PREPARED_STATEMENTS exist in this connection's server
+    # session. In autocommit a PREPARE lasts as soon as it runs; inside a
+    # transaction it is pending until commit, and rolling back a transaction
+    # that prepared statements runs DEALLOCATE ALL, so the bookkeeping never
+    # names a statement the server has lost.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.pending_prepared = set()  # prepared in the open transaction
+
+    def commit(self):
+        super().commit()
+        self.prepared |= self.pending_prepared
+        self.pending_prepared.clear()
+
+    def rollback(self):
+        super().rollback()
+        if self.pending_prepared:
+            self.prepared.clear()
+            self.pending_prepared.clear()
+            with self.cursor() as cur:
+                cur.execute("DEALLOCATE ALL")
+            super().commit()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(**pool_settings, **db_params, connection_factory=PreparingConnection)
+                atexit.register(_pool.closeall)
+                metrics.registry.register_gauge('washgo_db_pool_connections', lambda: get_pool().stats())
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def use_database(dbname):
+    # Point the module at another database (e.g. a throwaway one for tooling).
+    # Pooled connections to the old database are closed.
+    global _schema_ready
+    stop_change_listener()
+    close_pool()
+    db_params['dbname'] = dbname
+    _schema_ready = False
+
+@contextmanager
+def get_db_connection():
+    db_pool = get_pool()
+    conn = db_pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # The connection itself is suspect; don't hand it to another session
+        discard = True
+        raise
     finally:
-        cur.close()
-        conn.close()
+        db_pool.putconn(conn, discard=discard)
+
+def _create_base_schema(cur):
+    # Create sequence for users table if it doesn't exist
+    cur.execute('''
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_sequences WHERE schemaname = 'public' AND sequencename = 'users_id_seq') THEN
+            CREATE SEQUENCE users_id_seq START 1;
+        END IF;
+    END
+    $$;
+    ''')
+
+    # Create new users table without loyalty points and referral code
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY DEFAULT nextval('users_id_seq'),
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password VARCHAR(100) NOT NULL,
+        email VARCHAR(100) UNIQUE NOT NULL,
+        phone VARCHAR(20) NOT NULL,
+        is_admin BOOLEAN DEFAULT FALSE,
+        is_first_time_customer BOOLEAN DEFAULT TRUE
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        pickup_date DATE NOT NULL,
+        pickup_time TIME NOT NULL,
+        location TEXT NOT NULL,
+        status VARCHAR(20) DEFAULT 'Pending',
+        weight FLOAT,
+        item_count INTEGER,
+        total_price FLOAT
+    )
+    """)
+
+def _import_users_old(cur):
+    # Check if users_old table exists
+    cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'users_old')")
+    users_old_exists = cur.fetchone()[0]
+
+    if users_old_exists:
+        # Check if email and phone columns exist in users_old table
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users_old' AND column_name IN ('email', 'phone')")
+        existing_columns = [row[0] for row in cur.fetchall()]
+
+        # Modify the INSERT statement based on existing columns
+        if 'email' in existing_columns and 'phone' in existing_columns:
+            insert_query = '''
+            INSERT INTO users (id, username, password, email, phone, is_admin)
+            SELECT id, username, password, 
+                COALESCE(email, username || '@example.com') as email,
+                COALESCE(phone, '1234567890') as phone,
+                is_admin 
+            FROM users_old
+            ON CONFLICT (id) DO NOTHING
+            '''
+        else:
+            insert_query = '''
+            INSERT INTO users (id, username, password, email, phone, is_admin)
+            SELECT id, username, password, 
+                username || '@example.com' as email,
+                '1234567890' as phone,
+                is_admin 
+            FROM users_old
+            ON CONFLICT (id) DO NOTHING
+            '''
+
+        cur.execute(insert_query)
+
+        # Now we can safely drop the users_old table
+        cur.execute("DROP TABLE IF EXISTS users_old")
+
+    # Update the sequence to the maximum ID
+    cur.execute('''
+    SELECT setval('users_id_seq', COALESCE((SELECT MAX(id) FROM users), 0) + 1, false);
+    ''')
+
+# Rows each rollup trigger function adds (+1) or takes away (-1)
+_ADDED_ORDERS = "SELECT pickup_date, status, user_id, 1 AS count, total_price AS revenue FROM new_rows"
+_REMOVED_ORDERS = "SELECT pickup_date, status, user_id, -1 AS count, -total_price AS revenue FROM old_rows"
+ROLLUP_CHANGES = {
+    'rollup_orders_inserted': _ADDED_ORDERS,
+    'rollup_orders_updated': f"{_REMOVED_ORDERS} UNION ALL {_ADDED_ORDERS}",
+    'rollup_orders_deleted': _REMOVED_ORDERS,
+}
+
+def _rollup_function_sql(function, changes):
+    # Sum the changes per rollup row, skip rows whose changes cancel out (e.g.
+    # an update that didn't touch the rolled-up columns) and upsert in key
+    # order, so concurrent writers lock rollup rows in the same order
+    return f"""
+    CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+    BEGIN
+        WITH changes AS ({changes}), daily AS (
+            INSERT INTO order_daily_rollup AS r (day, status, order_count, revenue)
+            SELECT pickup_date, COALESCE(status, 'Unknown'), SUM(count), COALESCE(SUM(revenue), 0) FROM changes
+            GROUP BY 1, 2 HAVING SUM(count) <> 0 OR COALESCE(SUM(revenue), 0) <> 0
+            ORDER BY 1, 2
+            ON CONFLICT (day, status) DO UPDATE
+            SET order_count = r.order_count + EXCLUDED.order_count, revenue = r.revenue + EXCLUDED.revenue
+        )
+        INSERT INTO customer_revenue_rollup AS c (user_id, order_count, revenue)
+        SELECT user_id, SUM(count), COALESCE(SUM(revenue), 0) FROM changes
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id HAVING SUM(count) <> 0 OR COALESCE(SUM(revenue), 0) <> 0
+        ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET order_count = c.order_count + EXCLUDED.order_count, revenue = c.revenue + EXCLUDED.revenue;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """
+
+def _create_order_rollups(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS order_daily_rollup (
+        day DATE NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        order_count BIGINT NOT NULL DEFAULT 0,
+        revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, status)
+    );
+    CREATE TABLE IF NOT EXISTS customer_revenue_rollup (
+        user_id INTEGER PRIMARY KEY,
+        order_count BIGINT NOT NULL DEFAULT 0,
+        revenue DOUBLE PRECISION NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_customer_revenue_rollup_revenue ON customer_revenue_rollup (revenue DESC);
+    """)
+    for function, changes in ROLLUP_CHANGES.items():
+        cur.execute(_rollup_function_sql(function, changes))
+    # Statement-level with transition tables, so a bulk write applies one
+    # aggregated delta per rollup row. A trigger with a transition table may
+    # only handle one kind of event.
+    cur.execute("""
+    DROP TRIGGER IF EXISTS orders_rollup_insert ON orders;
+    CREATE TRIGGER orders_rollup_insert AFTER INSERT ON orders
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders_inserted();
+    DROP TRIGGER IF EXISTS orders_rollup_update ON orders;
+    CREATE TRIGGER orders_rollup_update AFTER UPDATE ON orders
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders_updated();
+    DROP TRIGGER IF EXISTS orders_rollup_delete ON orders;
+    CREATE TRIGGER orders_rollup_delete AFTER DELETE ON orders
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION rollup_orders_deleted();
+    """)
+    # Backfill from existing orders
+    cur.execute(REBUILD_ROLLUPS_SQL)
+
+# Ordered schema migrations: (version, description, SQL string or function
+# taking a cursor). Each step runs once in its own transaction and is recorded
+# in schema_version. Append new steps at the end; never edit applied ones.
+MIGRATIONS = [
+    (1, "Create users and orders tables", _create_base_schema),
+    (2, "Import legacy users_old table", _import_users_old),
+    (3, "Drop referrals table", "DROP TABLE IF EXISTS referrals"),
+    (4, "Add indexes for dashboard and history queries", """
+    CREATE INDEX IF NOT EXISTS idx_orders_user_pickup_date ON orders (user_id, pickup_date DESC);
+    CREATE INDEX IF NOT EXISTS idx_orders_pickup_date ON orders (pickup_date);
+    CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
+    CREATE INDEX IF NOT EXISTS idx_users_first_time ON users (id) WHERE is_first_time_customer = TRUE;
+    """),
+    (5, "Track data versions for change-driven refresh", """
+    CREATE SEQUENCE IF NOT EXISTS orders_data_version_seq;
+    CREATE SEQUENCE IF NOT EXISTS users_data_version_seq;
+
+    -- nextval never waits for other transactions, so writers to the same
+    -- table don't queue behind each other on a shared version row
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM changed_rows) THEN
+            RETURN NULL;
+        END IF;
+        PERFORM pg_notify('data_changed', TG_TABLE_NAME || ':' || nextval((TG_TABLE_NAME || '_data_version_seq')::regclass));
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    -- Statement-level, skipping statements that changed no rows. A trigger
+    -- with a transition table may only handle one kind of event.
+    DROP TRIGGER IF EXISTS orders_data_version_insert ON orders;
+    CREATE TRIGGER orders_data_version_insert AFTER INSERT ON orders
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    DROP TRIGGER IF EXISTS orders_data_version_update ON orders;
+    CREATE TRIGGER orders_data_version_update AFTER UPDATE ON orders
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    DROP TRIGGER IF EXISTS orders_data_version_delete ON orders;
+    CREATE TRIGGER orders_data_version_delete AFTER DELETE ON orders
+        REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    DROP TRIGGER IF EXISTS users_data_version_insert ON users;
+    CREATE TRIGGER users_data_version_insert AFTER INSERT ON users
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    DROP TRIGGER IF EXISTS users_data_version_update ON users;
+    CREATE TRIGGER users_data_version_update AFTER UPDATE ON users
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    DROP TRIGGER IF EXISTS users_data_version_delete ON users;
+    CREATE TRIGGER users_data_version_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+    """),
+    (6, "Cover keyset pagination of order history", """
+    CREATE INDEX IF NOT EXISTS idx_orders_user_pickup_date_id ON orders (user_id, pickup_date DESC, id DESC);
+    DROP INDEX IF EXISTS idx_orders_user_pickup_date;
+    """),
+    (7, "Index order prices for admin price filter bounds", """
+    CREATE INDEX IF NOT EXISTS idx_orders_total_price ON orders (total_price);
+    """),
+    (8, "Maintain daily order and customer revenue rollups", _create_order_rollups),
+    (9, "Log order status changes to an append-only table", """
+    CREATE TABLE IF NOT EXISTS order_status_events (
+        id BIGSERIAL PRIMARY KEY,
+        order_id INTEGER NOT NULL REFERENCES orders(id),
+        from_status VARCHAR(20),
+        to_status VARCHAR(20) NOT NULL,
+        changed_by INTEGER REFERENCES users(id),
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_status_events_order_id ON order_status_events (order_id, changed_at);
+
+    CREATE OR REPLACE FUNCTION reject_order_status_event_change() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'order_status_events is append-only';
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS order_status_events_append_only ON order_status_events;
+    CREATE TRIGGER order_status_events_append_only BEFORE UPDATE OR DELETE ON order_status_events
+        FOR EACH ROW EXECUTE FUNCTION reject_order_status_event_change();
+    DROP TRIGGER IF EXISTS order_status_events_no_truncate ON order_status_events;
+    CREATE TRIGGER order_status_events_no_truncate BEFORE TRUNCATE ON order_status_events
+        FOR EACH STATEMENT EXECUTE FUNCTION reject_order_status_event_change();
+    """),
+    (10, "Persist pending orders for the asynchronous checkout pipeline", """
+    CREATE TABLE IF NOT EXISTS pending_orders (
+        id SERIAL PRIMARY KEY,
+        idempotency_key UUID NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL REFERENCES users(id),
+        pickup_date DATE NOT NULL,
+        pickup_time TIME NOT NULL,
+        location TEXT NOT NULL,
+        weight FLOAT,
+        item_count INTEGER,
+        total_price FLOAT NOT NULL,
+        state VARCHAR(20) NOT NULL DEFAULT 'creating',
+        checkout_session_id TEXT UNIQUE,
+        checkout_url TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS idx_pending_orders_state_updated_at ON pending_orders (state, updated_at);
+    ALTER TABLE orders ADD COLUMN IF NOT EXISTS checkout_session_id TEXT UNIQUE;
+    """),
+    (11, "Track pickup slot capacity per service area and window", """
+    CREATE TABLE IF NOT EXISTS pickup_slots (
+        service_area TEXT NOT NULL,
+        slot_date DATE NOT NULL,
+        window_start TIME NOT NULL,
+        capacity INTEGER NOT NULL CHECK (capacity >= 0),
+        remaining INTEGER NOT NULL CHECK (remaining >= 0),
+        PRIMARY KEY (service_area, slot_date, window_start),
+        CHECK (remaining <= capacity)
+    );
+    ALTER TABLE pending_orders ADD COLUMN IF NOT EXISTS service_area TEXT;
+    """),
+    (12, "Notify which customers' orders changed", """
+    -- Large batches send '*' to stay under the NOTIFY payload limit
+    CREATE OR REPLACE FUNCTION notify_customer_orders_changed() RETURNS trigger AS $$
+    DECLARE
+        user_ids INTEGER[];
+    BEGIN
+        SELECT array_agg(DISTINCT user_id) INTO user_ids FROM changed_rows WHERE user_id IS NOT NULL;
+        IF user_ids IS NULL THEN
+            RETURN NULL;
+        END IF;
+        PERFORM pg_notify('customer_orders_changed',
+            CASE WHEN cardinality(user_ids) > 500 THEN '*' ELSE array_to_string(user_ids, ',') END);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER orders_customers_insert AFTER INSERT ON orders
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_customer_orders_changed();
+    CREATE TRIGGER orders_customers_update AFTER UPDATE ON orders
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_customer_orders_changed();
+    CREATE TRIGGER orders_customers_delete AFTER DELETE ON orders
+        REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_customer_orders_changed();
+    """),
+]
+
+# Arbitrary key for pg_advisory_lock so concurrent processes migrate one at a time
+SCHEMA_LOCK_ID = 727_274_001
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def latest_schema_version():
+    return MIGRATIONS[-1][0]
+
+def get_schema_version(cur):
+    cur.execute("SELECT to_regclass('public.schema_version')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def migrate(conn):
+    # Each migration commits together with its schema_version row
+    conn.autocommit = False
+    with conn.cursor() as cur:
+        if get_schema_version(cur) >= latest_schema_version():
+            conn.rollback()
+            return
+        cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+        try:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            conn.commit()
+            # Another process may have migrated while we waited for the lock
+            current = get_schema_version(cur)
+            for version, description, step in MIGRATIONS:
+                if version <= current:
+                    continue
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+                cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+            conn.commit()
+
+def init_db():
+    # Streamlit re-executes main.py on every interaction, so only the first
+    # call in a process talks to the database.
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        try:
+            with get_db_connection() as conn:
+                migrate(conn)
+            _schema_ready = True
+        except psycopg2.Error as e:
+            print(f"An error occurred: {e}")
 
 def execute_query(query, params=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if params:
-        cur.execute(query, params)
-    else:
-        cur.execute(query)
-    conn.commit()
-    cur.close()
-    conn.close()
+    with profiling.span('db'), get_db_connection() as conn:
+        with conn.cursor() as cur, metrics.timed_query(query) as timer:
+            cur.execute(query, params or None)
+            timer.rows = max(cur.rowcount, 0)
 
 def fetch_one(query, params=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if params:
-        cur.execute(query, params)
-    else:
-        cur.execute(query)
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with profiling.span('db'), get_db_connection() as conn:
+        with conn.cursor() as cur, metrics.timed_query(query) as timer:
+            cur.execute(query, params or None)
+            result = cur.fetchone()
+            timer.rows = int(result is not None)
     return result
 
 def fetch_all(query, params=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    if params:
-        cur.execute(query, params)
-    else:
-        cur.execute(query)
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
+    with profiling.span('db'), get_db_connection() as conn:
+        with conn.cursor() as cur, metrics.timed_query(query) as timer:
+            cur.execute(query, params or None)
+            result = cur.fetchall()
+            timer.rows = len(result)
+    return result
+
+class Transaction:
+    # Statements run through transaction() share one connection and commit
+    # together; through autocommit() each commits on its own. Rows come back
+    # as dicts keyed by column name.
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, query, params=None):
+        with metrics.timed_query(query) as timer:
+            self.cur.execute(query, params or None)
+            timer.rows = max(self.cur.rowcount, 0)
+        return self.cur.rowcount
+
+    def fetch_one(self, query, params=None):
+        with metrics.timed_query(query) as timer:
+            self.cur.execute(query, params or None)
+            result = self.cur.fetchone()
+            timer.rows = int(result is not None)
+        return result
+
+    def fetch_all(self, query, params=None):
+        with metrics.timed_query(query) as timer:
+            self.cur.execute(query, params or None)
+            result = self.cur.fetchall()
+            timer.rows = len(result)
+        return result
+
+    def fetch_one_prepared(self, name, params):
+        with metrics.timed_query(PREPARED_STATEMENTS[name]) as timer:
+            execute_prepared(self.cur, name, params)
+            result = self.cur.fetchone()
+            timer.rows = int(result is not None)
+        return result
+
+    def fetch_all_prepared(self, name, params):
+        with metrics.timed_query(PREPARED_STATEMENTS[name]) as timer:
+            execute_prepared(self.cur, name, params)
+            result = self.cur.fetchall()
+            timer.rows = len(result)
+        return result
+
+@contextmanager
+def autocommit():
+    # For blocks that run one statement: no BEGIN and COMMIT round trips
+    with profiling.span('db'), get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            yield Transaction(cur)
+
+@contextmanager
+def transaction():
+    # Commits when the block exits normally and rolls back if it raises.
+    # Costs a BEGIN and a COMMIT round trip, so only for several statements.
+    with profiling.span('db'), get_db_connection() as conn:
+        conn.autocommit = False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                yield Transaction(cur)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# Rows per round trip for iter_query's server-side cursors
+DB_ITERSIZE = int(os.environ.get('DB_ITERSIZE', 2000))
+
+_cursor_names = itertools.count(1)
+
+def iter_query(query, params=None, itersize=DB_ITERSIZE):
+    # Yield rows from a named server-side cursor, itersize at a time, so memory
+    # stays flat however large the result is. The pooled connection is held
+    # until the generator is exhausted or closed. Only time spent waiting on
+    # Postgres is recorded, not the time the caller spends on each batch.
+    with get_db_connection() as conn:
+        # Named cursors only live inside a transaction
+        conn.autocommit = False
+        with conn.cursor(name=f'iter_query_{next(_cursor_names)}') as cur:
+            seconds, rows, error = 0.0, 0, False
+            try:
+                start = time.perf_counter()
+                cur.execute(query, params or None)
+                batch = cur.fetchmany(itersize)
+                seconds += time.perf_counter() - start
+                while batch:
+                    rows += len(batch)
+                    yield from batch
+                    start = time.perf_counter()
+                    batch = cur.fetchmany(itersize)
+                    seconds += time.perf_counter() - start
+            except Exception:
+                error = True
+                raise
+            finally:
+                metrics.record_query(query, seconds, rows, error=error)
+        conn.commit()
+
+# Calls one call_concurrently batch runs at once. The worker threads are
+# shared by every session and sized to the pool, so concurrent sessions'
+# batches are limited by connections rather than by a few threads.
+DB_CONCURRENCY = int(os.environ.get('DB_CONCURRENCY', 4))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=pool_settings['maxconn'], thread_name_prefix='db-query')
+    return _executor
+
+def call_concurrently(calls):
+    # Run independent zero-argument database calls in parallel, each on its
+    # own pooled connection, and return their results in order. The calls
+    # must not call call_concurrently themselves.
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    executor = _get_executor()
+    with profiling.span('db'):
+        futures, running = [], set()
+        for call in calls:
+            if len(running) >= DB_CONCURRENCY:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            # Each call keeps the caller's page context for metrics
+            future = executor.submit(contextvars.copy_context().run, profiling.run_detached, call)
+            futures.append(future)
+            running.add(future)
+        return [future.result() for future in futures]
+
+def fetch_many_concurrently(queries):
+    # queries is a list of (query, params) pairs; returns one fetch_all result per query
+    return call_concurrently([functools.partial(fetch_all, query, params) for query, params in queries])
+
+ORDER_STATUSES = ["Pending", "Paid", "Picked Up", "In Progress", "Ready for Delivery", "Delivered", "Cancelled"]
+
+# Statuses each status may move to: forward through the lifecycle, or to
+# Cancelled until the order is delivered
+ALLOWED_TRANSITIONS = {
+    "Pending": ["Paid", "Picked Up", "In Progress", "Ready for Delivery", "Delivered", "Cancelled"],
+    "Paid": ["Picked Up", "In Progress", "Ready for Delivery", "Delivered", "Cancelled"],
+    "Picked Up": ["In Progress", "Ready for Delivery", "Delivered", "Cancelled"],
+    "In Progress": ["Ready for Delivery", "Delivered", "Cancelled"],
+    "Ready for Delivery": ["Delivered", "Cancelled"],
+    "Delivered": [],
+    "Cancelled": [],
+}
+
+ORDER_COLUMNS = ['id', 'user_id', 'pickup_date', 'pickup_time', 'location', 'status', 'weight', 'item_count', 'total_price']
+
+def order_columns(alias=None):
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + column for column in ORDER_COLUMNS)
+
+# Column types for fetch_frame, keyed by result column name. Statuses are in
+# lifecycle order; the rollups report orders without a status as 'Unknown'.
+# Money stays float64: float32 shows 41.9 as 41.900002 and loses cents in
+# large revenue sums.
+STATUS_DTYPE = pd.CategoricalDtype(ORDER_STATUSES + ['Unknown'], ordered=True)
+FRAME_DTYPES = {
+    'id': 'int32',
+    'user_id': 'Int32',
+    'item_count': 'Int32',
+    'count': 'int32',
+    'status': STATUS_DTYPE,
+    'weight': 'float32',
+    'total_price': 'float64',
+}
+FRAME_DATE_COLUMNS = {'pickup_date'}
+
+def fetch_frame(query, params=None):
+    # Load a result into pandas through COPY ... TO STDOUT instead of row
+    # tuples. Column names come from the query, so alias computed columns to
+    # a name in FRAME_DTYPES to get a compact type.
+    buffer = io.BytesIO()
+    with profiling.span('db'), get_db_connection() as conn:
+        with conn.cursor() as cur, metrics.timed_query(query) as timer:
+            bound = cur.mogrify(query, params or None).decode()
+            cur.copy_expert(f"COPY ({bound}) TO STDOUT WITH (FORMAT csv, HEADER true)", buffer)
+            timer.rows = max(cur.rowcount, 0)
+    with profiling.span('pandas'):
+        buffer.seek(0)
+        columns = next(csv.reader([buffer.readline().decode()]))
+        buffer.seek(0)
+        return pd.read_csv(
+            buffer,
+            dtype={column: FRAME_DTYPES[column] for column in columns if column in FRAME_DTYPES},
+            parse_dates=[column for column in columns if column in FRAME_DATE_COLUMNS],
+            keep_default_na=False,
+            na_values=[''],
+        )
+
+USER_COLUMNS = ['id', 'username', 'password', 'email', 'phone', 'is_admin', 'is_first_time_customer']
+
+# Hot statements, prepared on first use in each pooled connection and then
+# run with EXECUTE so Postgres skips parsing and planning them again.
+PREPARED_STATEMENTS = {
+    'find_user_by_username': f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE username = $1",
+    'fetch_recent_orders': f"SELECT {order_columns()} FROM orders WHERE user_id = $1 ORDER BY pickup_date DESC LIMIT $2",
+    # Turn paid checkouts into orders. The state check and the unique
+    # checkout_session_id make this safe to run for the same session twice.
+    'finalize_paid_checkouts': """
+        WITH paid AS (
+            UPDATE pending_orders SET state = 'paid', updated_at = now()
+            WHERE checkout_session_id = ANY($1::text[]) AND state = 'open'
+            RETURNING user_id, pickup_date, pickup_time, location, weight, item_count, total_price, checkout_session_id
+        ), new_orders AS (
+            INSERT INTO orders (user_id, pickup_date, pickup_time, location, weight, item_count, total_price, status, checkout_session_id)
+            SELECT user_id, pickup_date, pickup_time, location, weight, item_count, total_price, 'Paid', checkout_session_id FROM paid
+            ON CONFLICT (checkout_session_id) DO NOTHING
+            RETURNING id, user_id, checkout_session_id
+        ), customers AS (
+            UPDATE users SET is_first_time_customer = FALSE
+            WHERE id IN (SELECT user_id FROM new_orders) AND is_first_time_customer
+        )
+        SELECT id, user_id, checkout_session_id FROM new_orders
+    """,
+    # Lock the requested orders that may move to the new status, update them
+    # and log the change, then report every requested order that exists
+    'transition_orders': """
+        WITH movable AS (
+            SELECT id, status FROM orders
+            WHERE id = ANY($1::int[]) AND status = ANY($2::varchar[])
+            ORDER BY id
+            FOR UPDATE
+        ), updated AS (
+            UPDATE orders o SET status = $3 FROM movable
+            WHERE o.id = movable.id
+            RETURNING o.id, o.user_id, movable.status AS from_status
+        ), events AS (
+            INSERT INTO order_status_events (order_id, from_status, to_status, changed_by)
+            SELECT id, from_status, $3, $4 FROM updated
+        )
+        SELECT o.id, o.status, o.user_id, updated.id IS NOT NULL AS updated
+        FROM orders o LEFT JOIN updated ON updated.id = o.id
+        WHERE o.id = ANY($1::int[])
+    """,
+}
+
+_prepared_stats = {'hits': 0, 'misses': 0}
+_prepared_stats_lock = threading.Lock()
+
+def _execute_sql(name, params):
+    placeholders = sql.SQL(', ').join(sql.Placeholder() * len(params))
+    return sql.SQL("EXECUTE {} ({})").format(sql.Identifier(name), placeholders)
+
+def _ensure_prepared(cur, name):
+    # Prepare the statement on this connection if it is not there yet
+    conn = cur.connection
+    hit = name in conn.prepared or name in conn.pending_prepared
+    if not hit:
+        cur.execute(sql.SQL("PREPARE {} AS ").format(sql.Identifier(name)) + sql.SQL(PREPARED_STATEMENTS[name]))
+        (conn.prepared if conn.autocommit else conn.pending_prepared).add(name)
+    with _prepared_stats_lock:
+        _prepared_stats['hits' if hit else 'misses'] += 1
+
+def execute_prepared(cur, name, params):
+    _ensure_prepared(cur, name)
+    cur.execute(_execute_sql(name, params), params)
+
+def prepared_statement_stats():
+    with _prepared_stats_lock:
+        lookups = _prepared_stats['hits'] + _prepared_stats['misses']
+        return {**_prepared_stats, 'hit_rate': _prepared_stats['hits'] / lookups if lookups else 0.0}
+
+metrics.registry.register_gauge('washgo_prepared_statements', prepared_statement_stats)
+
+def find_user_by_username(username):
+    # The user as a dict keyed by USER_COLUMNS, or None
+    with autocommit() as tx:
+        return tx.fetch_one_prepared('find_user_by_username', (username,))
+
+def register_user(username, password_hash, email, phone):
+    # Insert and read back the new user in one statement. Returns None if the
+    # username is taken; a duplicate email raises psycopg2.errors.UniqueViolation.
+    with autocommit() as tx:
+        return tx.fetch_one(
+            f"""
+            INSERT INTO users (username, password, email, phone) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (username) DO NOTHING
+            RETURNING {', '.join(column for column in USER_COLUMNS if column != 'password')}
+            """,
+            (username, password_hash, email, phone)
+        )
+
+# Per-customer read cache. Entries are keyed by the customer's orders version,
+# read before the query runs, so bumping the version retires them at once and
+# a read that races an order write stores its result under the old version.
+# The order writes below bump the customers they touch, and the change
+# listener bumps them for orders written by other processes, such as the
+# payment webhook server and poller. Retired entries age out through the TTL,
+# which also bounds staleness while the listener is down.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+USER_VERSIONS_SIZE = int(os.environ.get('USER_VERSIONS_SIZE', 65536))
+
+_user_reads = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+metrics.registry.register_gauge('washgo_user_read_cache', _user_reads.stats)
+
+_MISSING = object()
+
+def cached_user_read(func, user_id, *args):
+    # func(user_id, *args), cached until the customer's orders change.
+    # Results are shared between sessions, so callers must not modify them.
+    get_change_listener()
+    key = (user_id, user_orders_version(user_id), func.__name__, args)
+    result = _user_reads.get(key, _MISSING)
+    if result is _MISSING:
+        result = func(user_id, *args)
+        _user_reads.set(key, result)
     return result
 
+# Bumped with each invalidation, so pages can tell when one customer's
+# orders changed without reacting to everyone else's. A customer's entry is
+# only needed while reads cached before the bump can still be live, so
+# entries older than the TTL are dropped once the table fills up.
+_user_versions = {}
+_user_versions_lock = threading.Lock()
+_user_version_counter = itertools.count(1)
+_all_users_version = 0
+
+def user_orders_version(user_id):
+    entry = _user_versions.get(user_id)
+    return (_all_users_version, entry[0] if entry else 0)
+
+def _prune_user_versions():
+    global _all_users_version
+    cutoff = time.monotonic() - USER_CACHE_TTL
+    for user_id, (_, bumped_at) in list(_user_versions.items()):
+        if bumped_at < cutoff:
+            del _user_versions[user_id]
+    if len(_user_versions) >= USER_VERSIONS_SIZE:
+        # Too many recent bumps to keep; move every customer on instead
+        _user_versions.clear()
+        _all_users_version = next(_user_version_counter)
+
+def invalidate_user_reads(user_id):
+    with _user_versions_lock:
+        if user_id not in _user_versions and len(_user_versions) >= USER_VERSIONS_SIZE:
+            _prune_user_versions()
+        _user_versions[user_id] = (next(_user_version_counter), time.monotonic())
+
+def invalidate_all_user_reads():
+    global _all_users_version
+    _all_users_version = next(_user_version_counter)
+    _user_reads.clear()
+
+def fetch_recent_orders(user_id, limit=5):
+    with autocommit() as tx:
+        return tx.fetch_all_prepared('fetch_recent_orders', (user_id, limit))
+
+# Pending order lifecycle: creating (Checkout Session being created), then
+# open (awaiting payment) or failed; open ends as paid or expired
+PENDING_ORDER_COLUMNS = [
+    'id', 'idempotency_key', 'user_id', 'service_area', 'pickup_date', 'pickup_time', 'location', 'weight', 'item_count',
+    'total_price', 'state', 'checkout_session_id', 'checkout_url', 'error', 'attempts', 'created_at', 'updated_at',
+]
+
+# Pickups each service area can take per window, for slots created from now on
+PICKUP_SLOT_CAPACITY = int(os.environ.get('PICKUP_SLOT_CAPACITY', 10))
+
+def ensure_slots(service_area, slot_date, windows, capacity=PICKUP_SLOT_CAPACITY):
+    # Create any missing slots for the day; existing slots keep their counts
+    execute_query(
+        """
+        INSERT INTO pickup_slots (service_area, slot_date, window_start, capacity, remaining)
+        SELECT %s, %s, window_start, %s, %s FROM unnest(%s::time[]) AS window_start
+        ON CONFLICT DO NOTHING
+        """,
+        (service_area, slot_date, capacity, capacity, list(windows))
+    )
+
+def pickup_availability(service_area, slot_date, windows):
+    # [(window_start, remaining)] for the day, creating its slots on first use.
+    # Reads one primary key range.
+    query = """
+        SELECT window_start, remaining FROM pickup_slots
+        WHERE service_area = %s AND slot_date = %s
+        ORDER BY window_start
+    """
+    slots = fetch_all(query, (service_area, slot_date))
+    if not slots and windows:
+        ensure_slots(service_area, slot_date, windows)
+        slots = fetch_all(query, (service_area, slot_date))
+    return slots
+
+def create_pending_order(order, idempotency_key):
+    # Take one place in the order's pickup slot and save the pending order in
+    # the same statement. The conditional decrement locks the slot row, so
+    # concurrent bookings of a popular window queue briefly on it and never
+    # oversell. A key that was already used returns its pending order without
+    # taking another place. Returns (pending order id, created), or
+    # (None, False) if the slot is full.
+    try:
+        with autocommit() as tx:
+            row = tx.fetch_one(
+                """
+                WITH existing AS (
+                    SELECT id FROM pending_orders WHERE idempotency_key = %(idempotency_key)s
+                ), slot AS (
+                    UPDATE pickup_slots SET remaining = remaining - 1
+                    WHERE service_area = %(service_area)s AND slot_date = %(pickup_date)s
+                        AND window_start = %(pickup_time)s AND remaining > 0
+                        AND NOT EXISTS (SELECT 1 FROM existing)
+                    RETURNING service_area
+                ), created AS (
+                    INSERT INTO pending_orders (idempotency_key, user_id, service_area, pickup_date, pickup_time, location, weight, item_count, total_price)
+                    SELECT %(idempotency_key)s, %(user_id)s, service_area, %(pickup_date)s, %(pickup_time)s, %(location)s, %(weight)s, %(item_count)s, %(total_price)s
+                    FROM slot
+                    RETURNING id
+                )
+                SELECT id, TRUE AS created FROM created
+                UNION ALL SELECT id, FALSE AS created FROM existing
+                """,
+                {**order, 'idempotency_key': idempotency_key}
+            )
+    except psycopg2.errors.UniqueViolation:
+        # A concurrent submission with the same key inserted first; this
+        # statement rolled back, slot decrement included
+        with autocommit() as tx:
+            row = tx.fetch_one("SELECT id, FALSE AS created FROM pending_orders WHERE idempotency_key = %s", (idempotency_key,))
+    if row is None:
+        return None, False
+    return row['id'], row['created']
+
+# Gives the pickup slots of pending orders that ended without payment back.
+# Follows a "released" CTE returning those orders' slot columns.
+RELEASE_SLOTS_CTE = """
+    restored AS (
+        UPDATE pickup_slots s SET remaining = s.remaining + r.count
+        FROM (
+            SELECT service_area, pickup_date, pickup_time, COUNT(*) AS count FROM released
+            WHERE service_area IS NOT NULL GROUP BY 1, 2, 3
+        ) r
+        WHERE s.service_area = r.service_area AND s.slot_date = r.pickup_date AND s.window_start = r.pickup_time
+    )
+"""
+
+def get_pending_order(pending_id):
+    with autocommit() as tx:
+        return tx.fetch_one(f"SELECT {', '.join(PENDING_ORDER_COLUMNS)} FROM pending_orders WHERE id = %s", (pending_id,))
+
+def mark_checkout_open(pending_id, checkout_session_id, checkout_url, attempts):
+    execute_query(
+        """
+        UPDATE pending_orders
+        SET state = 'open', checkout_session_id = %s, checkout_url = %s, attempts = attempts + %s, error = NULL, updated_at = now()
+        WHERE id = %s AND state = 'creating'
+        """,
+        (checkout_session_id, checkout_url, attempts, pending_id)
+    )
+
+def mark_checkout_failed(pending_id, error, attempts):
+    execute_query(
+        f"""
+        WITH released AS (
+            UPDATE pending_orders SET state = 'failed', error = %s, attempts = attempts + %s, updated_at = now()
+            WHERE id = %s AND state = 'creating'
+            RETURNING service_area, pickup_date, pickup_time
+        ), {RELEASE_SLOTS_CTE}
+        SELECT COUNT(*) FROM released
+        """,
+        (error, attempts, pending_id)
+    )
+
+def pending_orders_in_state(state, older_than=0, limit=500):
+    # Oldest first; older_than is in seconds since the last state change
+    with autocommit() as tx:
+        return tx.fetch_all(
+            f"""
+            SELECT {', '.join(PENDING_ORDER_COLUMNS)} FROM pending_orders
+            WHERE state = %s AND updated_at < now() - make_interval(secs => %s)
+            ORDER BY updated_at LIMIT %s
+            """,
+            (state, older_than, limit)
+        )
+
+def finalize_paid_checkouts(checkout_session_ids):
+    # Create the orders for paid Checkout Sessions in one statement. Sessions
+    # already finalized are skipped. Returns the new orders' (id, user_id,
+    # checkout_session_id) rows.
+    if not checkout_session_ids:
+        return []
+    with autocommit() as tx:
+        rows = tx.fetch_all_prepared('finalize_paid_checkouts', (list(checkout_session_ids),))
+    for user_id in {row['user_id'] for row in rows}:
+        invalidate_user_reads(user_id)
+    return rows
+
+def expire_checkouts(checkout_session_ids):
+    # Returns the ids of the pending orders that expired; their slots are released
+    if not checkout_session_ids:
+        return []
+    with autocommit() as tx:
+        rows = tx.fetch_all(
+            f"""
+            WITH released AS (
+                UPDATE pending_orders SET state = 'expired', updated_at = now()
+                WHERE checkout_session_id = ANY(%s) AND state = 'open'
+                RETURNING id, service_area, pickup_date, pickup_time
+            ), {RELEASE_SLOTS_CTE}
+            SELECT id FROM released
+            """,
+            (list(checkout_session_ids),)
+        )
+    return [row['id'] for row in rows]
+
+def find_order_by_checkout(checkout_session_id):
+    with autocommit() as tx:
+        return tx.fetch_one(f"SELECT {order_columns()} FROM orders WHERE checkout_session_id = %s", (checkout_session_id,))
+
+def transition_orders(order_ids, status, changed_by=None):
+    # Move many orders to status in one round trip. Orders whose current
+    # status may not move there are left alone. Returns (updated ids,
+    # {order id: current status or None if there is no such order} for the rest).
+    if status not in ORDER_STATUSES:
+        raise ValueError(f"Unknown order status: {status}")
+    order_ids = sorted(set(order_ids))
+    if not order_ids:
+        return [], {}
+    from_statuses = [current for current, targets in ALLOWED_TRANSITIONS.items() if status in targets]
+    with autocommit() as tx:
+        rows = tx.fetch_all_prepared('transition_orders', (order_ids, from_statuses, status, changed_by))
+    updated = sorted(row['id'] for row in rows if row['updated'])
+    skipped = {order_id: None for order_id in order_ids}
+    skipped.update({row['id']: row['status'] for row in rows if not row['updated']})
+    for order_id in updated:
+        del skipped[order_id]
+    for user_id in {row['user_id'] for row in rows if row['updated']}:
+        invalidate_user_reads(user_id)
+    return updated, skipped
+
+FIRST_TIME_CUSTOMER_ORDERS_QUERY = f"""
+    SELECT {order_columns('o')} FROM orders o
+    JOIN users u ON o.user_id = u.id
+    WHERE u.is_first_time_customer = TRUE
+"""
+
+def fetch_first_time_customer_orders():
+    return fetch_frame(FIRST_TIME_CUSTOMER_ORDERS_QUERY)
+
 def is_first_time_customer(user_id):
     result = fetch_one("SELECT is_first_time_customer FROM users WHERE id = %s", (user_id,))
     return result[0] if result else False
 
-def set_customer_order_placed(user_id):
-    execute_query("UPDATE users SET is_first_time_customer = FALSE WHERE id = %s", (user_id,))
+def build_order_filter(statuses=None, date_range=None, price_range=None, date_column='pickup_date'):
+    # Turn the admin filters into a WHERE clause over indexed order columns.
+    # date_range and price_range are (low, high) pairs; either end may be None.
+    conditions, params = [], []
+    if statuses:
+        conditions.append("status = ANY(%s)")
+        params.append(list(statuses))
+    for column, bounds in ((date_column, date_range), ('total_price', price_range)):
+        low, high = bounds if bounds else (None, None)
+        if low is not None:
+            conditions.append(f"{column} >= %s")
+            params.append(low)
+        if high is not None:
+            conditions.append(f"{column} <= %s")
+            params.append(high)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, tuple(params)
+
+# The *_query functions return the (query, params) a read runs, so
+# check_query_plans explains exactly what the pages send.
+def orders_page_query(filters, limit=50, offset=0):
+    where, params = build_order_filter(**filters)
+    return f"SELECT {order_columns()} FROM orders {where} ORDER BY pickup_date DESC, id DESC LIMIT %s OFFSET %s", params + (limit, offset)
+
+def fetch_orders_filtered(filters, limit=50, offset=0):
+    return fetch_frame(*orders_page_query(filters, limit, offset))
+
+def iter_orders_filtered(filters):
+    # Every matching order in id order, streamed for exports
+    where, params = build_order_filter(**filters)
+    return iter_query(f"SELECT {order_columns()} FROM orders {where} ORDER BY id", params)
+
+def count_orders_query(filters):
+    # Without a price filter the daily rollup has the count, so the default
+    # view doesn't count the whole orders table
+    if not filters.get('price_range'):
+        where, params = build_order_filter(filters.get('statuses'), filters.get('date_range'), date_column='day')
+        return f"SELECT COALESCE(SUM(order_count), 0)::bigint FROM order_daily_rollup {where}", params
+    where, params = build_order_filter(**filters)
+    return f"SELECT COUNT(*) FROM orders {where}", params
+
+def count_orders_filtered(filters):
+    return fetch_one(*count_orders_query(filters))[0]
+
+# (min date, max date, min price, max price); each is an index endpoint lookup
+ORDER_FILTER_BOUNDS_QUERY = "SELECT MIN(pickup_date), MAX(pickup_date), MIN(total_price), MAX(total_price) FROM orders"
+
+def order_filter_bounds():
+    return fetch_one(ORDER_FILTER_BOUNDS_QUERY)
+
+# The chart aggregates read the rollup tables maintained by the orders_rollup
+# triggers, so their cost depends on the number of days, not orders.
+ORDERS_BY_STATUS_QUERY = "SELECT status, SUM(order_count)::int AS count FROM order_daily_rollup GROUP BY status HAVING SUM(order_count) > 0 ORDER BY 2 DESC"
+
+def orders_by_status():
+    return fetch_frame(ORDERS_BY_STATUS_QUERY)
+
+def daily_counts_query(date_range=None):
+    where, params = build_order_filter(date_range=date_range, date_column='day')
+    return f"SELECT day AS pickup_date, SUM(order_count)::int AS count FROM order_daily_rollup {where} GROUP BY day HAVING SUM(order_count) > 0 ORDER BY day", params
+
+def daily_counts(date_range=None):
+    return fetch_frame(*daily_counts_query(date_range))
+
+def daily_revenue_query(date_range=None):
+    where, params = build_order_filter(date_range=date_range, date_column='day')
+    return f"SELECT day AS pickup_date, SUM(revenue) AS total_price FROM order_daily_rollup {where} GROUP BY day HAVING SUM(order_count) > 0 ORDER BY day", params
+
+def daily_revenue(date_range=None):
+    return fetch_frame(*daily_revenue_query(date_range))
+
+def top_customers_query(n=10):
+    return "SELECT user_id, revenue AS total_price FROM customer_revenue_rollup WHERE order_count > 0 ORDER BY revenue DESC LIMIT %s", (n,)
+
+def top_customers(n=10):
+    return fetch_frame(*top_customers_query(n))
+
+REBUILD_ROLLUPS_SQL = """
+LOCK TABLE orders IN SHARE MODE;
+TRUNCATE order_daily_rollup, customer_revenue_rollup;
+INSERT INTO order_daily_rollup (day, status, order_count, revenue)
+SELECT pickup_date, COALESCE(status, 'Unknown'), COUNT(*), COALESCE(SUM(total_price), 0)
+FROM orders GROUP BY 1, 2;
+INSERT INTO customer_revenue_rollup (user_id, order_count, revenue)
+SELECT user_id, COUNT(*), COALESCE(SUM(total_price), 0)
+FROM orders WHERE user_id IS NOT NULL GROUP BY user_id;
+"""
+
+def rebuild_order_rollups():
+    # Recompute the rollups from orders, e.g. after a backfill or bulk load.
+    # Writes to orders wait for the rebuild to commit. The statements go in
+    # one query string, which Postgres runs as a single transaction.
+    execute_query(REBUILD_ROLLUPS_SQL)
+
+def count_first_time_customers():
+    return fetch_one("SELECT COUNT(*) FROM users WHERE is_first_time_customer = TRUE")[0]
+
+def explain(query, params=None):
+    rows = fetch_one("EXPLAIN (FORMAT JSON) " + query, params)
+    return rows[0][0]['Plan']
+
+def explain_prepared(name, params):
+    # The plan a PREPARED_STATEMENTS entry runs with these parameters
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            _ensure_prepared(cur, name)
+            cur.execute(sql.SQL("EXPLAIN (FORMAT JSON) ") + _execute_sql(name, params), params)
+            rows = cur.fetchone()
+    return rows[0][0]['Plan']
+
+def user_orders_page_query(user_id, after=None, limit=20):
+    # Keyset pagination over a customer's orders, newest first. after is the
+    # (pickup_date, id) of the last order already shown.
+    if after is None:
+        return f"SELECT {order_columns()} FROM orders WHERE user_id = %s ORDER BY pickup_date DESC, id DESC LIMIT %s", (user_id, limit)
+    return f"""
+        SELECT {order_columns()} FROM orders
+        WHERE user_id = %s AND (pickup_date, id) < (%s, %s)
+        ORDER BY pickup_date DESC, id DESC LIMIT %s
+    """, (user_id, after[0], after[1], limit)
+
+def fetch_user_orders_page(user_id, after=None, limit=20):
+    return fetch_all(*user_orders_page_query(user_id, after, limit))
+
+USER_ORDERS_BY_STATUS_QUERY = "SELECT status, COUNT(*)::int AS count FROM orders WHERE user_id = %s GROUP BY status ORDER BY COUNT(*) DESC"
+
+def user_orders_by_status(user_id):
+    return fetch_frame(USER_ORDERS_BY_STATUS_QUERY, (user_id,))
+
+USER_SPENDING_BY_DATE_QUERY = "SELECT pickup_date, SUM(total_price) AS total_price FROM orders WHERE user_id = %s GROUP BY pickup_date ORDER BY pickup_date"
+
+def user_spending_by_date(user_id):
+    return fetch_frame(USER_SPENDING_BY_DATE_QUERY, (user_id,))
+
+CHANGE_CHANNEL = 'data_changed'
+CUSTOMER_CHANNEL = 'customer_orders_changed'
+
+DATA_TABLES = ('orders', 'users')
+
+# The last version handed out for each table. nextval is not transactional,
+# so a write still in flight can show here before it commits, and data read
+# under such a version may not contain it. Only the change listener's
+# versions, which move when a NOTIFY arrives after commit, can key caches.
+DATA_VERSIONS_QUERY = """
+    SELECT 'orders', last_value FROM orders_data_version_seq
+    UNION ALL SELECT 'users', last_value FROM users_data_version_seq
+"""
+
+class ChangeListener:
+    # One background thread per process LISTENs for the NOTIFYs sent by the
+    # data_version triggers and keeps the latest version of each table in
+    # memory, so sessions can poll for changes without touching the database.
+    # Its versions are local to the process and move on every committed
+    # change. It also drops the cached reads of customers whose orders changed.
+    def __init__(self, conn_params, channel=CHANGE_CHANNEL, customer_channel=CUSTOMER_CHANNEL, reconnect_delay=5):
+        self.conn_params = conn_params
+        self.channel = channel
+        self.customer_channel = customer_channel
+        self.reconnect_delay = reconnect_delay
+        self.healthy = False
+        self._versions = {}
+        self._version_counter = itertools.count(1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='db-change-listener', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def versions(self):
+        return dict(self._versions)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                print(f"Change listener error: {e}")
+            self._stop.wait(self.reconnect_delay)
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.conn_params)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.customer_channel)))
+            # Changes made while disconnected are unknown, so treat every
+            # table and customer as changed once LISTEN is in place
+            for table in DATA_TABLES:
+                self._versions[table] = next(self._version_counter)
+            invalidate_all_user_reads()
+            self.healthy = True
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel == self.customer_channel:
+                        self._invalidate_customers(notify.payload)
+                        continue
+                    table = notify.payload.partition(':')[0]
+                    self._versions[table] = next(self._version_counter)
+        finally:
+            self.healthy = False
+            conn.close()
+
+    def _invalidate_customers(self, payload):
+        if payload == '*':
+            invalidate_all_user_reads()
+            return
+        for user_id in payload.split(','):
+            invalidate_user_reads(int(user_id))
+
+_change_listener = None
+_change_listener_lock = threading.Lock()
+
+def get_change_listener():
+    global _change_listener
+    if os.environ.get('DB_CHANGE_LISTENER', '1') == '0':
+        return None
+    if _change_listener is None:
+        with _change_listener_lock:
+            if _change_listener is None:
+                _change_listener = ChangeListener(dict(db_params))
+                _change_listener.start()
+    return _change_listener
+
+def stop_change_listener():
+    global _change_listener
+    with _change_listener_lock:
+        if _change_listener is not None:
+            _change_listener.stop()
+            _change_listener = None
+
+def data_versions():
+    # {table_name: version}, bumped by triggers on every statement that
+    # changes rows in that table. Compare them for changes; only key caches
+    # on them while data_versions_cacheable() is true.
+    listener = get_change_listener()
+    if listener is not None and listener.healthy:
+        return listener.versions()
+    return dict(fetch_all(DATA_VERSIONS_QUERY))
+
+def data_versions_cacheable():
+    # Whether data_versions() comes from the change listener and so only
+    # reflects committed writes
+    listener = get_change_listener()
+    return listener is not None and listener.healthy
@@ -0,0 +1,87 @@
+import csv
+import itertools
+import os
+import tempfile
+from datetime import date
+import pyarrow as pa
+import pyarrow.parquet as pq
+import database
+
+# Order exports for accounting. Rows are streamed from a server-side cursor
+# and written out batch by batch, so an export of the whole orders table uses
+# the same memory as an export of one day.
+
+EXPORT_FORMATS = ('csv', 'parquet')
+MIME_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+PARQUET_BATCH_ROWS = 50_000
+
+ORDER_SCHEMA = pa.schema([
+    ('id', pa.int32()),
+    ('user_id', pa.int32()),
+    ('pickup_date', pa.date32()),
+    ('pickup_time', pa.time64('us')),
+    ('location', pa.string()),
+    ('status', pa.string()),
+    ('weight', pa.float64()),
+    ('item_count', pa.int32()),
+    ('total_price', pa.float64()),
+])
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(database.ORDER_COLUMNS)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def write_parquet(rows, path, batch_rows=PARQUET_BATCH_ROWS):
+    count = 0
+    with pq.ParquetWriter(path, ORDER_SCHEMA) as writer:
+        while True:
+            batch = list(itertools.islice(rows, batch_rows))
+            if not batch:
+                break
+            columns = [pa.array(column, type=field.type) for column, field in zip(zip(*batch), ORDER_SCHEMA)]
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=ORDER_SCHEMA))
+            count += len(batch)
+    return count
+
+WRITERS = {
+    'csv': write_csv,
+    'parquet': write_parquet,
+}
+
+def export_orders(path, export_format='csv', statuses=None, date_range=None):
+    # Write the matching orders to path and return how many were written
+    if export_format not in WRITERS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    rows = database.iter_orders_filtered({'statuses': statuses, 'date_range': date_range})
+    try:
+        return WRITERS[export_format](rows, path)
+    finally:
+        # Release the cursor's connection even if writing failed part way
+        rows.close()
+
+def export_file_name(export_format, date_range=None):
+    if date_range:
+        return f"orders-{date_range[0]}-to-{date_range[1]}.{export_format}"
+    return f"orders-{date.today()}.{export_format}"
+
+def export_to_bytes(export_format='csv', statuses=None, date_range=None):
+    # Returns (file contents, row count) for serving as a download. The
+    # orders are streamed through a temporary file, which is removed at once
+    # so no copy of the customers' addresses is left on disk.
+    fd, path = tempfile.mkstemp(prefix='washgo-orders-', suffix=f'.{export_format}')
+    os.close(fd)
+    try:
+        count = export_orders(path, export_format, statuses, date_range)
+        with open(path, 'rb') as f:
+            return f.read(), count
+    finally:
+        os.remove(path)
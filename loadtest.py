@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import psycopg2
+from streamlit.testing.v1 import AppTest
+
+import database
+import synthetic_data
+from auth import hash_password
+
+# Drives main.py through Streamlit's AppTest with many concurrent simulated
+# sessions against a throwaway database. Stripe and the Places API are served
+# by a local stub, so the run never leaves the machine.
+
+ADMIN_USERNAME = 'loadtest_admin'
+
+class StubHandler(BaseHTTPRequestHandler):
+    sessions = {}
+    idempotent_responses = {}  # Idempotency-Key -> (payload, status), as Stripe replays them
+    failure_rate = 0.0  # Share of session creations answered with a 500
+    lock = threading.Lock()
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/places/autocomplete':
+            self._json({'status': 'OK', 'predictions': [
+                {'description': f'{number} Main St, Silver Spring, MD 20910, USA'} for number in range(100, 103)
+            ]})
+        elif path.startswith('/v1/checkout/sessions/'):
+            session_id = path.rsplit('/', 1)[-1]
+            with self.lock:
+                session = self.sessions.get(session_id)
+            if session is None:
+                self._json({'error': {'type': 'invalid_request_error', 'message': 'No such checkout session'}}, status=404)
+            else:
+                self._json({**session, 'payment_status': 'paid', 'status': 'complete'})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path == '/v1/checkout/sessions':
+            idempotency_key = self.headers.get('Idempotency-Key')
+            with self.lock:
+                response = self.idempotent_responses.get(idempotency_key)
+                if response is None:
+                    if random.random() < self.failure_rate:
+                        response = ({'error': {'type': 'api_error', 'message': 'Injected failure'}}, 500)
+                    else:
+                        session_id = f'cs_test_{len(self.sessions) + 1}'
+                        session = {
+                            'id': session_id,
+                            'object': 'checkout.session',
+                            'url': f'http://{self.server.server_address[0]}:{self.server.server_address[1]}/pay/{session_id}',
+                            'payment_status': 'unpaid',
+                            'status': 'open',
+                        }
+                        self.sessions[session_id] = session
+                        response = (session, 200)
+                    if idempotency_key:
+                        self.idempotent_responses[idempotency_key] = response
+            self._json(*response)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(stripe_failure_rate=0.0):
+    StubHandler.failure_rate = stripe_failure_rate
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-stub', daemon=True).start()
+    host, port = server.server_address
+    os.environ['PLACES_API_URL'] = f'http://{host}:{port}/places/autocomplete'
+    os.environ['STRIPE_API_BASE'] = f'http://{host}:{port}'
+    os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_loadtest')
+    os.environ.setdefault('GOOGLE_PLACES_API_KEY', 'loadtest')
+    return server
+
+class ConnectionMonitor:
+    # Samples pg_stat_activity on its own connection to find the peak number
+    # of backends connected to the scratch database
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='loadtest-connections', daemon=True)
+
+    def _run(self):
+        conn = psycopg2.connect(**database.db_params)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                while not self._stop.is_set():
+                    # Exclude this monitoring connection
+                    cur.execute("SELECT count(*) - 1 FROM pg_stat_activity WHERE datname = current_database()")
+                    self.peak = max(self.peak, cur.fetchone()[0])
+                    self._stop.wait(self.interval)
+        finally:
+            conn.close()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def current_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def timed(self, action, at, step):
+        start = time.perf_counter()
+        try:
+            step()
+            failed = bool(at.exception) or bool(at.error)
+        except Exception:
+            failed = True
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[action].append(elapsed)
+            if failed:
+                self.errors[action] += 1
+
+def _main_button(at, label):
+    return next(button for button in at.main.button if button.label == label)
+
+def _text_input(at, label):
+    return next(text_input for text_input in at.text_input if text_input.label == label)
+
+def _log_in(at, username):
+    at.button(key='nav_login').click().run()
+    _text_input(at, "Username").input(username)
+    _text_input(at, "Password").input(synthetic_data.SYNTHETIC_PASSWORD)
+    _main_button(at, "Login").click().run()
+
+def _schedule_pickup(at):
+    at.button(key='nav_schedule_pickup').click().run()
+    area_select = at.selectbox(key='service_area_select')
+    area_select.select(random.choice(area_select.options)).run()
+    # Spread bookings over the open windows the way customers do; a full day
+    # leaves no window select and the checkout is skipped
+    window_select = at.selectbox(key='pickup_window_select') if any(s.key == 'pickup_window_select' for s in at.selectbox) else None
+    if window_select is None:
+        at.session_state['checkout_pending_id'] = None
+        return
+    window_select.select_index(random.randrange(len(window_select.options))).run()
+    at.text_input(key='location_input').input('100 Main').run()
+    location_select = at.selectbox(key='location_select')
+    if len(location_select.options) > 1:
+        location_select.select(location_select.options[1])
+    at.number_input[0].set_value(8.5)
+    at.button(key='proceed_to_payment_button').click().run()
+
+def _wait_for_checkout(pending_id, timeout):
+    # The Checkout Session is created on a payment worker; poll for it the way
+    # the checkout_progress fragment does
+    deadline = time.monotonic() + timeout
+    pending = database.get_pending_order(pending_id)
+    while pending['state'] == 'creating' and time.monotonic() < deadline:
+        time.sleep(0.05)
+        pending = database.get_pending_order(pending_id)
+    if pending['state'] != 'open':
+        raise RuntimeError(f"Checkout for pending order {pending_id} is {pending['state']}")
+    return pending
+
+def _return_from_payment(at, timeout):
+    pending_id = at.session_state['checkout_pending_id'] if 'checkout_pending_id' in at.session_state else None
+    if pending_id is None:
+        return
+    pending = _wait_for_checkout(pending_id, timeout)
+    at.query_params['session_id'] = pending['checkout_session_id']
+    at.run()
+    at.query_params.clear()
+
+def customer_session(recorder, username, rounds, think_time, timeout):
+    at = AppTest.from_file('main.py', default_timeout=timeout)
+    recorder.timed('open_home', at, at.run)
+    recorder.timed('login', at, lambda: _log_in(at, username))
+    for _ in range(rounds):
+        recorder.timed('schedule_pickup', at, lambda: _schedule_pickup(at))
+        recorder.timed('payment_return', at, lambda: _return_from_payment(at, timeout))
+        time.sleep(think_time)
+        recorder.timed('order_history', at, lambda: at.button(key='nav_order_history').click().run())
+        time.sleep(think_time)
+        recorder.timed('user_dashboard', at, lambda: at.button(key='nav_user_dashboard').click().run())
+        time.sleep(think_time)
+
+def admin_session(recorder, rounds, think_time, timeout):
+    at = AppTest.from_file('main.py', default_timeout=timeout)
+    recorder.timed('open_home', at, at.run)
+    recorder.timed('admin_login', at, lambda: _log_in(at, ADMIN_USERNAME))
+    for _ in range(rounds * 3):
+        recorder.timed('admin_refresh', at, at.run)
+        time.sleep(think_time)
+
+def create_admin():
+    database.execute_query(
+        "INSERT INTO users (username, password, email, phone, is_admin, is_first_time_customer) VALUES (%s, %s, %s, %s, TRUE, FALSE)",
+        (ADMIN_USERNAME, hash_password(synthetic_data.SYNTHETIC_PASSWORD), 'admin@example.com', '2025550100')
+    )
+
+def pending_order_states():
+    return dict(database.fetch_all("SELECT state, COUNT(*) FROM pending_orders GROUP BY state"))
+
+def summarize(recorder, wall_seconds, sessions, rss_baseline_kb, peak_rss_kb, peak_connections, checkout_states):
+    actions = {}
+    for action, samples in sorted(recorder.latencies.items()):
+        samples = sorted(samples)
+        actions[action] = {
+            'count': len(samples),
+            'errors': recorder.errors[action],
+            'p50_ms': statistics.median(samples) * 1000,
+            'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+        }
+    total_actions = sum(action['count'] for action in actions.values())
+    return {
+        'sessions': sessions,
+        'wall_seconds': wall_seconds,
+        'throughput_actions_per_second': total_actions / wall_seconds if wall_seconds else 0.0,
+        'peak_postgres_connections': peak_connections,
+        'rss_per_session_kb': max(peak_rss_kb - rss_baseline_kb, 0) / sessions if sessions else 0,
+        'pending_orders_by_state': checkout_states,
+        'actions': actions,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent session load test for main.py")
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--admin-share', type=float, default=0.1, help="Fraction of sessions that are admins")
+    parser.add_argument('--rounds', type=int, default=3, help="Scenario repetitions per session")
+    parser.add_argument('--think-time', type=float, default=0.2)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--users', type=int, default=5_000)
+    parser.add_argument('--orders', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stripe-failure-rate', type=float, default=0.0, help="Share of stub Checkout Session creations that fail with a 500")
+    parser.add_argument('--database', default=synthetic_data.SCRATCH_DATABASE)
+    parser.add_argument('--output', default='loadtest_results.json')
+    args = parser.parse_args()
+
+    start_stub_server(args.stripe_failure_rate)
+    synthetic_data.create_scratch_database(args.database)
+    try:
+        synthetic_data.load(args.users, args.orders, seed=args.seed)
+        create_admin()
+
+        rng = random.Random(args.seed)
+        n_admins = round(args.sessions * args.admin_share)
+        recorder = Recorder()
+        monitor = ConnectionMonitor()
+        rss_baseline_kb = current_rss_kb()
+        peak_rss_kb = rss_baseline_kb
+        monitor.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            futures = [executor.submit(admin_session, recorder, args.rounds, args.think_time, args.timeout) for _ in range(n_admins)]
+            futures += [
+                executor.submit(customer_session, recorder, f'user{rng.randint(1, args.users)}', args.rounds, args.think_time, args.timeout)
+                for _ in range(args.sessions - n_admins)
+            ]
+            while not all(future.done() for future in futures):
+                peak_rss_kb = max(peak_rss_kb, current_rss_kb())
+                time.sleep(0.2)
+            for future in futures:
+                future.result()
+        wall_seconds = time.perf_counter() - start
+        monitor.stop()
+
+        report = summarize(recorder, wall_seconds, args.sessions, rss_baseline_kb, peak_rss_kb, monitor.peak, pending_order_states())
+    finally:
+        synthetic_data.drop_scratch_database(args.database)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"{args.sessions} sessions in {report['wall_seconds']:.1f}s, "
+          f"{report['throughput_actions_per_second']:.1f} actions/s, "
+          f"peak {report['peak_postgres_connections']} Postgres connections, "
+          f"{report['rss_per_session_kb']:.0f} KB RSS per session")
+    print(f"  checkouts by state: {report['pending_orders_by_state']}")
+    for action, stats in report['actions'].items():
+        print(f"  {action:<18} n={stats['count']:<5} errors={stats['errors']:<4} p50 {stats['p50_ms']:8.1f} ms  p99 {stats['p99_ms']:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
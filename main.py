@@ -4,6 +4,8 @@ import auth
 import admin
 import user
 import utils
+import metrics
+import profiling
 
 # Initialize session state
 if 'user' not in st.session_state:
@@ -39,13 +41,7 @@ def home_page():
 
     with st.container():
         col1, col2, col3 = st.columns(3)
-        locations = [
-            'Bethesda, MD', 'Rockville, MD', 'Silver Spring, MD', 'Washington, D.C.', 'Gaithersburg, MD', 'Colesville, MD',
-            'Laurel, MD', 'Hyattsville, MD', 'Chevy Chase, MD', 'Wheaton, MD', 'Takoma Park, MD',
-            'Greenbelt, MD', 'Riverdale Park, MD', 'Falls Church, VA', 'Alexandria, VA', 'Arlington, VA',
-            'Vienna, VA', 'Beltsville, MD', 'College Park, MD', 'Bladensburg, MD', 'Lanham, MD',
-            'Bowie, MD', 'Mount Rainier, MD'
-        ]
+        locations = list(utils.SERVICE_AREAS)
         locations_per_column = len(locations) // 3 + (len(locations) % 3 > 0)
         
         with col1:
@@ -232,29 +228,32 @@ def main():
     try:
         # Handle successful payment redirect
         if 'session_id' in st.query_params:
-            user.handle_successful_payment()
+            with metrics.page_context("Payment Return"), profiling.profile_page("Payment Return"):
+                user.handle_successful_payment()
         
-        if st.session_state.page == "Home":
-            home_page()
-        elif st.session_state.page == "Login":
-            auth.login_page()
-        elif st.session_state.page == "Register":
-            auth.register_page()
-        elif st.session_state.page == "Admin Dashboard":
-            admin.admin_dashboard()
-        elif st.session_state.page == "User Dashboard":
-            user.user_dashboard()
-        elif st.session_state.page == "Schedule Pickup":
-            user.schedule_pickup()
-        elif st.session_state.page == "Order History":
-            user.order_history()
-        elif st.session_state.page == "Logout":
-            auth.logout()
-        else:
-            st.error(f"Page '{st.session_state.page}' not found.")
+        with metrics.page_context(st.session_state.page), profiling.profile_page(st.session_state.page):
+            if st.session_state.page == "Home":
+                home_page()
+            elif st.session_state.page == "Login":
+                auth.login_page()
+            elif st.session_state.page == "Register":
+                auth.register_page()
+            elif st.session_state.page == "Admin Dashboard":
+                admin.admin_dashboard()
+            elif st.session_state.page == "User Dashboard":
+                user.user_dashboard()
+            elif st.session_state.page == "Schedule Pickup":
+                user.schedule_pickup()
+            elif st.session_state.page == "Order History":
+                user.order_history()
+            elif st.session_state.page == "Logout":
+                auth.logout()
+            else:
+                st.error(f"Page '{st.session_state.page}' not found.")
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
 
 if __name__ == "__main__":
+    metrics.start_exporters()
     database.init_db()
     main()
@@ -0,0 +1,73 @@
+import argparse
+import os
+from datetime import date
+import database
+import export
+import payments
+
+# Maintenance commands: python manage.py <command>
+
+def migrate(args):
+    with database.get_db_connection() as conn:
+        database.migrate(conn)
+    print(f"Schema is at version {database.latest_schema_version()}")
+
+def rebuild_rollups(args):
+    database.rebuild_order_rollups()
+    print("Rebuilt order_daily_rollup and customer_revenue_rollup")
+
+def export_orders(args):
+    # The format defaults to the output file's extension
+    export_format = args.format or os.path.splitext(args.output)[1].lstrip('.').lower()
+    if export_format not in export.EXPORT_FORMATS:
+        raise SystemExit(f"Cannot tell the export format from {args.output}; pass --format")
+    date_range = (args.date_from, args.date_to) if args.date_from or args.date_to else None
+    count = export.export_orders(args.output, export_format, statuses=args.status, date_range=date_range)
+    print(f"Exported {count} orders to {args.output}")
+
+def add_export_arguments(parser):
+    parser.add_argument('output', help="File to write, e.g. orders.csv or orders.parquet")
+    parser.add_argument('--format', choices=export.EXPORT_FORMATS)
+    parser.add_argument('--status', action='append', choices=database.ORDER_STATUSES, help="Repeat to export several statuses")
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="First pickup date, YYYY-MM-DD")
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="Last pickup date, YYYY-MM-DD")
+
+def payments_webhook(args):
+    payments.serve_webhooks(args.port, args.host)
+
+def add_webhook_arguments(parser):
+    parser.add_argument('--port', type=int, default=payments.WEBHOOK_PORT)
+    parser.add_argument('--host', default='0.0.0.0')
+
+def payments_poll(args):
+    if not args.once:
+        payments.poll_forever(args.interval)
+    restarted, finalized, expired = payments.reconcile()
+    payments.wait_for_workers()
+    print(f"Restarted {restarted}, finalized {finalized} and expired {expired} checkout(s)")
+
+def add_poll_arguments(parser):
+    parser.add_argument('--once', action='store_true', help="Run a single reconciliation pass and exit")
+    parser.add_argument('--interval', type=float, default=payments.POLL_INTERVAL, help="Seconds between passes")
+
+COMMANDS = {
+    'migrate': (migrate, "Apply pending schema migrations", None),
+    'rebuild-rollups': (rebuild_rollups, "Recompute the order rollup tables from orders", None),
+    'export-orders': (export_orders, "Stream orders to a CSV or Parquet file", add_export_arguments),
+    'payments-webhook': (payments_webhook, "Receive Stripe webhooks and finalize paid checkouts", add_webhook_arguments),
+    'payments-poll': (payments_poll, "Reconcile pending checkouts with Stripe", add_poll_arguments),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Wash & Go Delivery maintenance commands")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (func, help_text, add_arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        if add_arguments:
+            add_arguments(subparser)
+        subparser.set_defaults(func=func)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
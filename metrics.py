@@ -0,0 +1,209 @@
+import contextvars
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Per-statement database metrics, aggregated by query fingerprint and the page
+# that issued the query, exported in Prometheus text format.
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+METRICS_PORT = os.environ.get('METRICS_PORT')
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_FILE_INTERVAL = float(os.environ.get('METRICS_FILE_INTERVAL', 15))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+current_page = contextvars.ContextVar('current_page', default='unknown')
+
+@contextmanager
+def page_context(page):
+    token = current_page.set(page)
+    try:
+        yield
+    finally:
+        current_page.reset(token)
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    # Strip literals and placeholders so the same statement with different
+    # values is counted once
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"%\(\w+\)s|%s", "?", query)
+    query = re.sub(r"\b\d+(?:\.\d+)?\b", "?", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+class QuerySeries:
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.rows = 0
+        self.errors = 0
+
+class QueryMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._series = {}  # (fingerprint, page) -> QuerySeries
+        self._gauges = {}  # name -> callable returning {label value: number}
+        self._lock = threading.Lock()
+
+    def observe(self, query_fingerprint, page, seconds, rows, error=False):
+        with self._lock:
+            series = self._series.get((query_fingerprint, page))
+            if series is None:
+                series = self._series[(query_fingerprint, page)] = QuerySeries(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series.bucket_counts[i] += 1
+                    break
+            series.count += 1
+            series.total_seconds += seconds
+            series.rows += rows
+            series.errors += int(error)
+
+    def register_gauge(self, name, callback):
+        self._gauges[name] = callback
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: {
+                    'count': series.count,
+                    'total_seconds': series.total_seconds,
+                    'rows': series.rows,
+                    'errors': series.errors,
+                    'bucket_counts': list(series.bucket_counts),
+                }
+                for key, series in self._series.items()
+            }
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP washgo_db_query_duration_seconds Database statement latency by query fingerprint and page.",
+            "# TYPE washgo_db_query_duration_seconds histogram",
+        ]
+        snapshot = self.snapshot()
+        for (query, page), series in sorted(snapshot.items()):
+            labels = f'query="{_escape(query)}",page="{_escape(page)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['bucket_counts']):
+                cumulative += count
+                lines.append(f'washgo_db_query_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'washgo_db_query_duration_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+            lines.append(f'washgo_db_query_duration_seconds_sum{{{labels}}} {series["total_seconds"]}')
+            lines.append(f'washgo_db_query_duration_seconds_count{{{labels}}} {series["count"]}')
+        lines.append("# HELP washgo_db_query_rows_total Rows returned or affected by query fingerprint and page.")
+        lines.append("# TYPE washgo_db_query_rows_total counter")
+        for (query, page), series in sorted(snapshot.items()):
+            lines.append(f'washgo_db_query_rows_total{{query="{_escape(query)}",page="{_escape(page)}"}} {series["rows"]}')
+        lines.append("# HELP washgo_db_query_errors_total Failed statements by query fingerprint and page.")
+        lines.append("# TYPE washgo_db_query_errors_total counter")
+        for (query, page), series in sorted(snapshot.items()):
+            lines.append(f'washgo_db_query_errors_total{{query="{_escape(query)}",page="{_escape(page)}"}} {series["errors"]}')
+        for name, callback in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for label, value in sorted(callback().items()):
+                lines.append(f'{name}{{state="{_escape(label)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+registry = QueryMetrics()
+
+_slow_log = logging.getLogger('washgo.slow_queries')
+_slow_log.propagate = False
+_slow_log_lock = threading.Lock()
+
+def _slow_query_logger():
+    if not _slow_log.handlers:
+        with _slow_log_lock:
+            if not _slow_log.handlers:
+                handler = logging.FileHandler(SLOW_QUERY_LOG)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                _slow_log.addHandler(handler)
+                _slow_log.setLevel(logging.INFO)
+    return _slow_log
+
+def record_query(query, seconds, rows, error=False):
+    page = current_page.get()
+    query_fingerprint = fingerprint(query)
+    registry.observe(query_fingerprint, page, seconds, rows, error)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        _slow_query_logger().info("%.1fms page=%s rows=%s error=%s %s", seconds * 1000, page, rows, error, query_fingerprint)
+
+class QueryTimer:
+    def __init__(self):
+        self.rows = 0
+
+@contextmanager
+def timed_query(query):
+    timer = QueryTimer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    except Exception:
+        record_query(query, time.perf_counter() - start, timer.rows, error=True)
+        raise
+    record_query(query, time.perf_counter() - start, timer.rows)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+def write_metrics_file(path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(registry.render_prometheus())
+    os.replace(tmp_path, path)
+
+def _write_metrics_file_forever(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_metrics_file(path)
+        except OSError as e:
+            print(f"Could not write metrics file: {e}")
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+def start_exporters():
+    # Start the configured exporters once per process; safe to call on every rerun
+    global _exporters_started
+    if _exporters_started:
+        return
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+        if METRICS_PORT:
+            try:
+                start_metrics_server(METRICS_PORT)
+            except OSError as e:
+                print(f"Could not start metrics server on port {METRICS_PORT}: {e}")
+        if METRICS_FILE:
+            threading.Thread(target=_write_metrics_file_forever, args=(METRICS_FILE, METRICS_FILE_INTERVAL),
+                             name='metrics-file-writer', daemon=True).start()
@@ -0,0 +1,275 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import stripe
+import database
+
+# Checkout pipeline. The order is saved as a pending order before Stripe is
+# called, its Checkout Session is created on a worker thread with an
+# idempotency key and retries, and paid sessions are turned into orders in
+# batches by whichever sees the payment first: the webhook server, the poller
+# or the customer returning to the app. Set STRIPE_API_BASE to run against a
+# local Stripe mock.
+#
+# Run `python manage.py payments-poll` next to the app, with or without
+# `payments-webhook`. The poller restarts stuck checkouts and expires
+# abandoned ones; without it, a pickup slot held by an unpaid checkout is
+# never released.
+
+stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+if os.environ.get('STRIPE_API_BASE'):
+    # e.g. a local stripe-mock or stub server
+    stripe.api_base = os.environ['STRIPE_API_BASE']
+
+APP_URL = os.environ.get('REPLIT_URL', 'http://localhost:5000')
+WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+WEBHOOK_PATH = '/stripe/webhook'
+WEBHOOK_PORT = int(os.environ.get('PAYMENT_WEBHOOK_PORT', 8502))
+
+PAYMENT_WORKERS = int(os.environ.get('PAYMENT_WORKERS', 4))
+CHECKOUT_MAX_ATTEMPTS = int(os.environ.get('CHECKOUT_MAX_ATTEMPTS', 4))
+CHECKOUT_RETRY_DELAY = float(os.environ.get('CHECKOUT_RETRY_DELAY', 0.5))  # doubles after each attempt
+FINALIZE_BATCH_SIZE = int(os.environ.get('FINALIZE_BATCH_SIZE', 100))
+FINALIZE_BATCH_WAIT = float(os.environ.get('FINALIZE_BATCH_WAIT', 0.5))
+POLL_INTERVAL = float(os.environ.get('PAYMENT_POLL_INTERVAL', 30))
+# A pending order still being created after this long lost its worker
+STALE_CREATING_SECONDS = 300
+# Unpaid sessions expire this long after the pending order was created, which
+# releases its pickup slot. Counted from created_at so retries and restarts
+# send identical parameters under the same idempotency key; Stripe needs at
+# least 30 minutes left when the session is created.
+CHECKOUT_EXPIRES_SECONDS = int(os.environ.get('CHECKOUT_EXPIRES_SECONDS', 3600))
+
+PAID_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PAYMENT_WORKERS, thread_name_prefix='payments')
+    return _executor
+
+def _is_retryable(error):
+    # Stripe saves the first response for an idempotency key, 500s included,
+    # and replays it, so only errors it never answered or did not save help
+    return isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError))
+
+def _checkout_params(pending):
+    return {
+        'payment_method_types': ['card'],
+        'line_items': [{
+            'price_data': {
+                'currency': 'usd',
+                'unit_amount': int(pending['total_price'] * 100),  # Stripe expects amount in cents
+                'product_data': {
+                    'name': 'Laundry Service',
+                    'description': f"Pickup on {pending['pickup_date']} at {pending['pickup_time']}",
+                },
+            },
+            'quantity': 1,
+        }],
+        'mode': 'payment',
+        'expires_at': int(pending['created_at'].timestamp()) + CHECKOUT_EXPIRES_SECONDS,
+        'success_url': f"{APP_URL}/?session_id={{CHECKOUT_SESSION_ID}}",
+        'cancel_url': f"{APP_URL}/",
+        'client_reference_id': str(pending['id']),
+        'metadata': {'pending_order_id': str(pending['id'])},
+    }
+
+def create_checkout_session(pending_id):
+    # Runs on a payment worker. Connection and rate-limit errors are retried
+    # with the same idempotency key, so a retry never creates a second session.
+    pending = database.get_pending_order(pending_id)
+    if pending is None or pending['state'] != 'creating':
+        return
+    for attempt in range(1, CHECKOUT_MAX_ATTEMPTS + 1):
+        try:
+            session = stripe.checkout.Session.create(**_checkout_params(pending), idempotency_key=pending['idempotency_key'])
+        except stripe.StripeError as e:
+            if attempt < CHECKOUT_MAX_ATTEMPTS and _is_retryable(e):
+                time.sleep(CHECKOUT_RETRY_DELAY * 2 ** (attempt - 1))
+                continue
+            print(f"Checkout for pending order {pending_id} failed after {attempt} attempt(s): {e}")
+            database.mark_checkout_failed(pending_id, str(e), attempt)
+            return
+        database.mark_checkout_open(pending_id, session.id, session.url, attempt)
+        return
+
+def _log_failure(future):
+    if future.exception() is not None:
+        print(f"Payment worker failed: {future.exception()}")
+
+def _submit(func, *args):
+    future = _get_executor().submit(func, *args)
+    future.add_done_callback(_log_failure)
+    return future
+
+def start_checkout(order, idempotency_key=None):
+    # Reserve the pickup slot, save the order as pending and create its
+    # Checkout Session in the background; poll the pending order for the
+    # checkout URL. Pass the same idempotency_key for a repeated submission of
+    # one form to get its pending order back. Returns the pending order id, or
+    # None if the pickup slot is full.
+    pending_id, created = database.create_pending_order(order, idempotency_key or str(uuid.uuid4()))
+    if created:
+        _submit(create_checkout_session, pending_id)
+    return pending_id
+
+def _retrieve_session(checkout_session_id):
+    try:
+        return stripe.checkout.Session.retrieve(checkout_session_id)
+    except stripe.StripeError as e:
+        print(f"Could not retrieve checkout session {checkout_session_id}: {e}")
+        return None
+
+def confirm_checkout(checkout_session_id):
+    # The order for a Checkout Session, finalizing it now if no worker has
+    # yet; None if the session is unknown or unpaid
+    order = database.find_order_by_checkout(checkout_session_id)
+    if order is None:
+        session = _retrieve_session(checkout_session_id)
+        if session is None or session.payment_status != 'paid':
+            return None
+        database.finalize_paid_checkouts([checkout_session_id])
+        order = database.find_order_by_checkout(checkout_session_id)
+    if order is not None:
+        # A webhook or poller process may have created the order, and this
+        # process's cached reads of the customer's orders predate it
+        database.invalidate_user_reads(order['user_id'])
+    return order
+
+class Finalizer:
+    # Collects paid Checkout Session ids and finalizes them in batches of up
+    # to batch_size, waiting at most batch_wait seconds for a batch to fill.
+    # A batch that fails is left for the poller to pick up.
+    def __init__(self, batch_size=FINALIZE_BATCH_SIZE, batch_wait=FINALIZE_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.finalized = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='payment-finalizer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, checkout_session_id):
+        self._queue.put(checkout_session_id)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.finalized += len(database.finalize_paid_checkouts(batch))
+            except Exception as e:
+                print(f"Could not finalize {len(batch)} checkout(s): {e}")
+
+def _parse_event(payload, signature):
+    if WEBHOOK_SECRET:
+        return stripe.Webhook.construct_event(payload, signature, WEBHOOK_SECRET)
+    return json.loads(payload)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    finalizer = None
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            event = _parse_event(payload, self.headers.get('Stripe-Signature'))
+        except (ValueError, stripe.SignatureVerificationError) as e:
+            self._json({'error': str(e)}, status=400)
+            return
+        session = event['data']['object']
+        if event['type'] in PAID_EVENTS:
+            if not WEBHOOK_SECRET:
+                # Unsigned events can't be trusted; ask Stripe instead
+                session = _retrieve_session(session['id']) or {}
+            if session.get('payment_status') == 'paid':
+                self.finalizer.submit(session['id'])
+        elif event['type'] == 'checkout.session.expired':
+            if not WEBHOOK_SECRET:
+                # Expiring an open session would release its slot and stop a
+                # later payment from becoming an order, so check with Stripe too
+                session = _retrieve_session(session['id']) or {}
+            if session.get('status') == 'expired':
+                database.expire_checkouts([session['id']])
+        self._json({'received': True})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_webhooks(port=WEBHOOK_PORT, host='0.0.0.0'):
+    if not WEBHOOK_SECRET:
+        print("STRIPE_WEBHOOK_SECRET is not set; verifying each event with Stripe instead of by signature")
+    finalizer = Finalizer()
+    finalizer.start()
+    handler = type('BoundWebhookHandler', (WebhookHandler,), {'finalizer': finalizer})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    print(f"Listening for Stripe webhooks on {host}:{port}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+def reconcile(limit=500):
+    # One poller pass: restart checkouts whose worker died, finalize paid
+    # sessions whose webhook never arrived and expire abandoned ones.
+    # Returns (restarted, finalized, expired) counts.
+    stale = database.pending_orders_in_state('creating', older_than=STALE_CREATING_SECONDS, limit=limit)
+    for pending in stale:
+        _submit(create_checkout_session, pending['id'])
+    open_orders = database.pending_orders_in_state('open', limit=limit)
+    sessions = list(_get_executor().map(_retrieve_session, [pending['checkout_session_id'] for pending in open_orders]))
+    paid = [session.id for session in sessions if session is not None and session.payment_status == 'paid']
+    expired = [session.id for session in sessions if session is not None and session.status == 'expired']
+    finalized = database.finalize_paid_checkouts(paid)
+    expired_ids = database.expire_checkouts(expired)
+    return len(stale), len(finalized), len(expired_ids)
+
+def poll_forever(interval=POLL_INTERVAL):
+    while True:
+        try:
+            restarted, finalized, expired = reconcile()
+            if restarted or finalized or expired:
+                print(f"Restarted {restarted}, finalized {finalized} and expired {expired} checkout(s)")
+        except Exception as e:
+            print(f"Payment poll failed: {e}")
+        time.sleep(interval)
+
+def wait_for_workers():
+    # Let submitted checkouts finish, e.g. before a one-off poll exits
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
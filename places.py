@@ -0,0 +1,106 @@
+import os
+import re
+import threading
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from cache import TTLCache
+
+# Google Places autocomplete with a shared suggestion cache. Point
+# PLACES_API_URL at a local stub server to run without the real API.
+PLACES_API_URL = os.environ.get('PLACES_API_URL', 'https://maps.googleapis.com/maps/api/place/autocomplete/json')
+
+MIN_INPUT_LENGTH = 3
+MAX_PREDICTIONS = 5  # The autocomplete API never returns more than five
+
+def new_session_token():
+    # Groups the keystrokes of one address lookup into a single billed session
+    return str(uuid.uuid4())
+
+def _normalize(input_text):
+    return ' '.join(input_text.split()).lower()
+
+def _tokens(text):
+    # Words without punctuation, so "main st silver" lines up with "Main St, Silver Spring"
+    return re.findall(r'\w+', text.lower())
+
+def _matches(key_tokens, suggestion):
+    # Every typed word is in the suggestion; the last one may still be partial
+    tokens = _tokens(suggestion)
+    *complete, partial = key_tokens
+    return all(token in tokens for token in complete) and any(token.startswith(partial) for token in tokens)
+
+class PlacesClient:
+    def __init__(self, api_key=None, base_url=PLACES_API_URL, session=None, timeout=(2, 3),
+                 cache=None, min_input_length=MIN_INPUT_LENGTH):
+        self.api_key = api_key if api_key is not None else os.environ.get("GOOGLE_PLACES_API_KEY")
+        self.base_url = base_url
+        self.timeout = timeout
+        self.min_input_length = min_input_length
+        self.cache = cache if cache is not None else TTLCache(maxsize=2048, ttl=3600)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=1))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=1))
+        self.session = session
+
+    def suggest(self, input_text, session_token=None):
+        key = _normalize(input_text or "")
+        if len(key) < self.min_input_length:
+            return []
+
+        suggestions = self.cache.get(key)
+        if suggestions is not None:
+            return suggestions
+        suggestions = self._from_cached_prefix(key)
+        if suggestions is None:
+            suggestions = self._fetch(input_text.strip(), session_token)
+        if suggestions is None:
+            return []
+        self.cache.set(key, suggestions)
+        return suggestions
+
+    def _from_cached_prefix(self, key):
+        # A shorter input that came back with fewer than MAX_PREDICTIONS results
+        # probably returned every match, so longer input can often be filtered
+        # locally. The API matches loosely, so when nothing is left the API is
+        # asked instead of caching an empty list.
+        key_tokens = _tokens(key)
+        if not key_tokens:
+            return None
+        for end in range(len(key) - 1, self.min_input_length - 1, -1):
+            cached = self.cache.peek(key[:end])
+            if cached is not None and len(cached) < MAX_PREDICTIONS:
+                return [suggestion for suggestion in cached if _matches(key_tokens, suggestion)] or None
+        return None
+
+    def _fetch(self, input_text, session_token):
+        params = {
+            "input": input_text,
+            "key": self.api_key,
+            "types": "address"
+        }
+        if session_token:
+            params["sessiontoken"] = session_token
+        try:
+            response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            payload = response.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Address lookup failed: {e}")
+            return None
+        if payload.get('status', 'OK') not in ('OK', 'ZERO_RESULTS'):
+            print(f"Address lookup failed: {payload.get('status')} {payload.get('error_message', '')}")
+            return None
+        return [prediction['description'] for prediction in payload.get('predictions', [])]
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PlacesClient()
+    return _client
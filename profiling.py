@@ -0,0 +1,158 @@
+import argparse
+import cProfile
+import contextvars
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Per-page render profiling. Each render records wall-clock and CPU time,
+# split into time spent in database calls, pandas work and Plotly figure
+# construction; whatever is left is attributed to widget emission.
+# PAGE_PROFILE_DIR turns on a cProfile dump per render and PAGE_PROFILE_LOG
+# appends every render record to a JSON lines file for offline reports.
+
+PROFILE_DIR = os.environ.get('PAGE_PROFILE_DIR')
+PROFILE_LOG = os.environ.get('PAGE_PROFILE_LOG')
+
+CATEGORIES = ('db', 'pandas', 'plotly', 'widgets')
+
+_current_render = contextvars.ContextVar('current_render', default=None)
+# cProfile can only run one profiler per process at a time (on 3.12+ it takes
+# the single sys.monitoring profiler slot), so concurrent renders take turns
+_profiler_lock = threading.Lock()
+
+class Render:
+    def __init__(self, page):
+        self.page = page
+        self.spans = dict.fromkeys(CATEGORIES, 0.0)
+        self.stack = []  # [category, started_at] of the open spans, innermost last
+
+@contextmanager
+def span(category):
+    # Time spent inside a span is exclusive: a nested span pauses its parent,
+    # so a query issued while building a DataFrame counts as db, not pandas.
+    render = _current_render.get()
+    if render is None:
+        yield
+        return
+    now = time.perf_counter()
+    if render.stack:
+        parent = render.stack[-1]
+        render.spans[parent[0]] += now - parent[1]
+    render.stack.append([category, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        render.spans[category] += now - render.stack.pop()[1]
+        if render.stack:
+            render.stack[-1][1] = now
+
+def run_detached(func, *args):
+    # Run func outside the current render's span accounting, e.g. on a worker
+    # thread whose time the waiting caller already counts
+    token = _current_render.set(None)
+    try:
+        return func(*args)
+    finally:
+        _current_render.reset(token)
+
+def _profile_path(page):
+    slug = re.sub(r'[^a-z0-9]+', '-', page.lower()).strip('-') or 'page'
+    return os.path.join(PROFILE_DIR, f"{slug}-{int(time.time() * 1000)}.prof")
+
+@contextmanager
+def profile_page(page):
+    render = Render(page)
+    token = _current_render.set(render)
+    profiler = None
+    if PROFILE_DIR:
+        if _profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        else:
+            print(f"Not writing a profile for {page}: another render is being profiled")
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        if profiler:
+            profiler.enable()
+        yield render
+    finally:
+        if profiler:
+            profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        _current_render.reset(token)
+        if profiler:
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(_profile_path(page))
+            except OSError as e:
+                print(f"Could not write profile for {page}: {e}")
+            finally:
+                _profiler_lock.release()
+        measured = render.spans['db'] + render.spans['pandas'] + render.spans['plotly']
+        render.spans['widgets'] = max(wall - measured, 0.0)
+        record_render({'page': page, 'timestamp': time.time(), 'wall': wall, 'cpu': cpu, **render.spans})
+
+def record_render(record):
+    if PROFILE_LOG:
+        try:
+            with open(PROFILE_LOG, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            print(f"Could not append to {PROFILE_LOG}: {e}")
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(records):
+    by_page = defaultdict(list)
+    for record in records:
+        by_page[record['page']].append(record)
+    rows = []
+    for page, page_records in by_page.items():
+        walls = [record['wall'] for record in page_records]
+        total_wall = sum(walls) or 1.0
+        row = {
+            'page': page,
+            'renders': len(page_records),
+            'wall_p50': percentile(walls, 0.5),
+            'wall_p95': percentile(walls, 0.95),
+            'cpu_p50': percentile([record['cpu'] for record in page_records], 0.5),
+        }
+        for category in CATEGORIES:
+            row[f'{category}_share'] = sum(record.get(category, 0.0) for record in page_records) / total_wall
+        rows.append(row)
+    return sorted(rows, key=lambda row: row['wall_p95'], reverse=True)
+
+def format_report(rows):
+    header = f"{'page':<24}{'renders':>9}{'p50 ms':>10}{'p95 ms':>10}{'cpu p50':>10}" + ''.join(f"{category:>9}" for category in CATEGORIES)
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        lines.append(
+            f"{row['page']:<24}{row['renders']:>9}{row['wall_p50'] * 1000:>10.1f}{row['wall_p95'] * 1000:>10.1f}{row['cpu_p50'] * 1000:>10.1f}"
+            + ''.join(f"{row[f'{category}_share']:>9.0%}" for category in CATEGORIES)
+        )
+    return '\n'.join(lines)
+
+def load_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank pages by render latency from a PAGE_PROFILE_LOG file")
+    parser.add_argument('log', nargs='?', default=PROFILE_LOG or 'page_profile.jsonl')
+    args = parser.parse_args()
+    print(format_report(summarize(load_records(args.log))))
+
+if __name__ == "__main__":
+    main()
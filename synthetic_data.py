@@ -0,0 +1,161 @@
+import argparse
+import io
+import itertools
+import math
+import random
+from datetime import date, time, timedelta
+import psycopg2
+from psycopg2 import sql
+import database
+import utils
+from auth import hash_password
+
+# Synthetic users and orders for query-plan checks and benchmarks. Everything
+# here runs against a throwaway database created next to the configured one.
+
+SCRATCH_DATABASE = 'washgo_scratch'
+SYNTHETIC_PASSWORD = 'password'
+
+# Orders settle within a few days of pickup; only recent and upcoming
+# pickups are still in flight.
+IN_FLIGHT_DAYS = 3
+UPCOMING_DAYS = 14
+IN_FLIGHT_STATUSES = {"Paid": 20, "Picked Up": 25, "In Progress": 30, "Ready for Delivery": 20, "Pending": 5}
+UPCOMING_STATUSES = {"Paid": 85, "Pending": 15}
+SETTLED_STATUSES = {"Delivered": 94, "Cancelled": 6}
+
+# Per-customer order counts follow a Zipf-like curve: a few subscription
+# customers order weekly, most order a handful of times.
+CUSTOMER_SKEW = 1.1
+
+USER_COLUMNS = ('id', 'username', 'password', 'email', 'phone', 'is_admin', 'is_first_time_customer')
+ORDER_COLUMNS = ('id', 'user_id', 'pickup_date', 'pickup_time', 'location', 'status', 'weight', 'item_count', 'total_price')
+
+LOCATIONS = [f"{number} Main St, {area}, USA" for number, area in enumerate(utils.SERVICE_AREAS, start=100)]
+
+def _maintenance_connection():
+    conn = psycopg2.connect(**{**database.db_params, 'dbname': 'postgres'})
+    conn.autocommit = True
+    return conn
+
+def create_scratch_database(name=SCRATCH_DATABASE):
+    if name == database.db_params.get('dbname'):
+        raise ValueError(f"Refusing to recreate the configured database '{name}'")
+    conn = _maintenance_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+    database.use_database(name)
+    database.init_db()
+
+def drop_scratch_database(name=SCRATCH_DATABASE):
+    database.close_pool()
+    conn = _maintenance_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+
+def _copy(cur, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(r'\N' if value is None else str(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_from(buf, table, columns=columns)
+
+def _weighted(statuses):
+    return list(statuses), list(itertools.accumulate(statuses.values()))
+
+def generate_orders(rng, n_customers, n_orders, start_date, days):
+    # Customer n has weight 1/n^CUSTOMER_SKEW, so user 1 is the heaviest
+    customer_ids = range(1, n_customers + 1)
+    customer_weights = list(itertools.accumulate(1 / rank ** CUSTOMER_SKEW for rank in customer_ids))
+    in_flight, in_flight_weights = _weighted(IN_FLIGHT_STATUSES)
+    upcoming, upcoming_weights = _weighted(UPCOMING_STATUSES)
+    settled, settled_weights = _weighted(SETTLED_STATUSES)
+    today = date.today()
+    for order_id in range(1, n_orders + 1):
+        # Volume grows over the years: density rises linearly towards today
+        offset = int((days + UPCOMING_DAYS) * math.sqrt(rng.random()))
+        pickup_date = start_date + timedelta(days=offset)
+        age = (today - pickup_date).days
+        if age < 0:
+            status = rng.choices(upcoming, cum_weights=upcoming_weights)[0]
+        elif age < IN_FLIGHT_DAYS:
+            status = rng.choices(in_flight, cum_weights=in_flight_weights)[0]
+        else:
+            status = rng.choices(settled, cum_weights=settled_weights)[0]
+        weight = round(rng.uniform(3, 25), 1)
+        yield (
+            order_id,
+            rng.choices(customer_ids, cum_weights=customer_weights)[0],
+            pickup_date,
+            time(rng.randrange(7, 21), rng.choice((0, 30))),
+            rng.choice(LOCATIONS),
+            status,
+            weight,
+            rng.randrange(1, 40),
+            round(utils.calculate_price_by_weight(weight), 2),
+        )
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def load(n_users, n_orders, seed=42, years=3, first_time_share=0.08, chunk_size=100_000):
+    # Deterministic for a given seed and day
+    rng = random.Random(seed)
+    days = 365 * years
+    start_date = date.today() - timedelta(days=days)
+    # Users above n_customers never ordered, so they are still first-time customers
+    n_customers = max(1, int(n_users * (1 - first_time_share)))
+    password = hash_password(SYNTHETIC_PASSWORD)
+    users = (
+        (user_id, f'user{user_id}', password, f'user{user_id}@example.com', '2025550100',
+         'f', 'f' if user_id <= n_customers else 't')
+        for user_id in range(1, n_users + 1)
+    )
+    with database.get_db_connection() as conn:
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            # The triggers would hold every loaded row in a transition table;
+            # load with them off and rebuild the rollups once at the end.
+            cur.execute("ALTER TABLE users DISABLE TRIGGER USER")
+            cur.execute("ALTER TABLE orders DISABLE TRIGGER USER")
+            for chunk in _chunks(users, chunk_size):
+                _copy(cur, 'users', USER_COLUMNS, chunk)
+            for chunk in _chunks(generate_orders(rng, n_customers, n_orders, start_date, days), chunk_size):
+                _copy(cur, 'orders', ORDER_COLUMNS, chunk)
+            cur.execute("ALTER TABLE users ENABLE TRIGGER USER")
+            cur.execute("ALTER TABLE orders ENABLE TRIGGER USER")
+            cur.execute(database.REBUILD_ROLLUPS_SQL)
+            cur.execute("SELECT setval('users_id_seq', %s)", (n_users,))
+            cur.execute("SELECT setval(pg_get_serial_sequence('orders', 'id'), %s)", (n_orders,))
+            cur.execute("ANALYZE users")
+            cur.execute("ANALYZE orders")
+        conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load synthetic users and orders into a scratch database")
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--orders', type=int, default=200_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', default=SCRATCH_DATABASE)
+    args = parser.parse_args()
+    create_scratch_database(args.database)
+    load(args.users, args.orders, seed=args.seed)
+    print(f"Loaded {args.users} users and {args.orders} orders into {args.database}")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,16 @@
 import streamlit as st
 import database
-import pandas as pd
 import plotly.express as px
 import time
+import uuid
 from datetime import datetime, timedelta
 import utils
-import requests
-import json
-import os
-import stripe
+import places
+import charts
+import payments
 
-# Set up Stripe
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-
-def get_address_suggestions(input_text):
-    api_key = os.environ.get("GOOGLE_PLACES_API_KEY")
-    base_url = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
-    params = {
-        "input": input_text,
-        "key": api_key,
-        "types": "address"
-    }
-    response = requests.get(base_url, params=params)
-    suggestions = json.loads(response.text)['predictions']
-    return [suggestion['description'] for suggestion in suggestions]
+def get_address_suggestions(input_text, session_token=None):
+    return places.get_client().suggest(input_text, session_token=session_token)
 
 def user_dashboard():
     st.title(f"Welcome to Wash & Go Delivery, {st.session_state.user['username']}! 👋")
@@ -32,10 +19,7 @@ def user_dashboard():
     if st.session_state.user['is_first_time_customer']:
         st.info("As a first-time customer, you're eligible for a 20% discount on your first order!")
     
-    recent_orders = database.fetch_all(
-        "SELECT * FROM orders WHERE user_id = %s ORDER BY pickup_date DESC LIMIT 5",
-        (st.session_state.user['id'],)
-    )
+    recent_orders = database.cached_user_read(database.fetch_recent_orders, st.session_state.user['id'])
     
     if recent_orders:
         st.subheader("Recent Orders")
@@ -43,11 +27,11 @@ def user_dashboard():
             with st.container():
                 col1, col2, col3 = st.columns([2, 1, 1])
                 with col1:
-                    st.write(f"Order #{order[0]} - {order[2]}")
+                    st.write(f"Order #{order['id']} - {order['pickup_date']}")
                 with col2:
-                    st.write(f"Status: {order[5]}")
+                    st.write(f"Status: {order['status']}")
                 with col3:
-                    st.write(f"Total: ${order[8]:.2f}")
+                    st.write(f"Total: ${order['total_price']:.2f}")
     else:
         st.info("You don't have any recent orders.")
     
@@ -73,15 +57,22 @@ def user_dashboard():
 def schedule_pickup():
     st.title("Schedule a Pickup with Wash & Go Delivery 📅")
     
+    service_area = st.selectbox("Service Area", options=list(utils.SERVICE_AREAS), key="service_area_select")
     col1, col2 = st.columns(2)
     with col1:
         pickup_date = st.date_input("Pickup Date", min_value=datetime.now().date())
     with col2:
-        pickup_time = st.time_input("Pickup Time")
+        pickup_time = pickup_window_select(service_area, pickup_date)
     
+    if 'places_session_token' not in st.session_state:
+        st.session_state.places_session_token = places.new_session_token()
     location_input = st.text_input("Pickup Location", key="location_input")
-    suggestions = get_address_suggestions(location_input)
+    suggestions = get_address_suggestions(location_input, st.session_state.places_session_token)
     location = st.selectbox("Select or confirm address", options=[""] + suggestions, key="location_select")
+    if location and location != st.session_state.get('places_selected_location'):
+        # Picking an address ends the autocomplete session
+        st.session_state.places_selected_location = location
+        st.session_state.places_session_token = places.new_session_token()
     
     col1, col2 = st.columns(2)
     with col1:
@@ -97,7 +88,7 @@ def schedule_pickup():
     st.markdown("---")
     st.subheader("Order Summary")
     st.write(f"Pickup Date: {pickup_date}")
-    st.write(f"Pickup Time: {pickup_time}")
+    st.write(f"Pickup Time: {utils.format_pickup_window(pickup_time) if pickup_time else ''}")
     st.write(f"Location: {location}")
     st.write(f"Estimated Weight: {weight} kg")
     st.write(f"Number of Items: {item_count}")
@@ -107,100 +98,179 @@ def schedule_pickup():
         if not (pickup_date and pickup_time and location):
             st.error("Please fill in all the fields.")
         else:
+            order = {
+                'user_id': st.session_state.user['id'],
+                'service_area': service_area,
+                'pickup_date': pickup_date,
+                'pickup_time': pickup_time,
+                'location': location,
+                'weight': weight,
+                'item_count': item_count,
+                'total_price': total_price,
+            }
             try:
-                checkout_session = stripe.checkout.Session.create(
-                    payment_method_types=['card'],
-                    line_items=[{
-                        'price_data': {
-                            'currency': 'usd',
-                            'unit_amount': int(total_price * 100),  # Stripe expects amount in cents
-                            'product_data': {
-                                'name': 'Laundry Service',
-                                'description': f'Pickup on {pickup_date} at {pickup_time}',
-                            },
-                        },
-                        'quantity': 1,
-                    }],
-                    mode='payment',
-                    success_url=f"{os.environ.get('REPLIT_URL', 'http://localhost:5000')}/?session_id={{CHECKOUT_SESSION_ID}}",
-                    cancel_url=f"{os.environ.get('REPLIT_URL', 'http://localhost:5000')}/",
-                )
-                
-                st.session_state.pending_order = {
-                    'user_id': st.session_state.user['id'],
-                    'pickup_date': pickup_date,
-                    'pickup_time': pickup_time,
-                    'location': location,
-                    'weight': weight,
-                    'item_count': item_count,
-                    'total_price': total_price,
-                    'checkout_session_id': checkout_session.id
-                }
-                
-                st.markdown(f'<script>window.location.href = "{checkout_session.url}";</script>', unsafe_allow_html=True)
-                
+                # The Checkout Session is created in the background; checkout_progress polls for it
+                pending_id = payments.start_checkout(order, checkout_idempotency_key(order))
+                if pending_id is None:
+                    st.error("That pickup window just filled up. Please choose another time.")
+                st.session_state.checkout_pending_id = pending_id
             except Exception as e:
                 st.error(f"An error occurred while processing your payment: {str(e)}")
+    
+    if st.session_state.get('checkout_pending_id'):
+        pending = database.get_pending_order(st.session_state.checkout_pending_id)
+        if pending is not None and pending['state'] == 'creating':
+            checkout_progress()
+        elif pending is not None:
+            checkout_status(pending)
+
+def pickup_window_select(service_area, pickup_date):
+    # Only windows with room left, and not ones already past today
+    slots = database.pickup_availability(service_area, pickup_date, utils.pickup_windows(pickup_date))
+    now = datetime.now()
+    open_slots = {
+        window_start: remaining for window_start, remaining in slots
+        if remaining > 0 and datetime.combine(pickup_date, window_start) > now
+    }
+    if not open_slots:
+        st.warning("No pickup windows are left on this day. Please choose another date.")
+        return None
+    # The label stays fixed as other bookings change the counts, so the
+    # selection isn't reset
+    window_start = st.selectbox("Pickup Time", options=list(open_slots), format_func=utils.format_pickup_window, key="pickup_window_select")
+    st.caption(f"{open_slots[window_start]} pickup(s) left in this window")
+    return window_start
+
+def checkout_idempotency_key(order):
+    # One key per submitted form, so a double click reuses the first pending
+    # order and its pickup slot. Changed details or a finished checkout get a
+    # new key.
+    signature = repr(sorted(order.items()))
+    saved = st.session_state.get('checkout_idempotency')
+    if saved is None or saved[0] != signature:
+        saved = st.session_state.checkout_idempotency = (signature, str(uuid.uuid4()))
+    return saved[1]
+
+CHECKOUT_POLL_INTERVAL = 1  # seconds
+
+@st.fragment(run_every=CHECKOUT_POLL_INTERVAL)
+def checkout_progress():
+    # Polls only while the Checkout Session is being created, then reruns the
+    # page once to show the outcome
+    pending = database.get_pending_order(st.session_state.checkout_pending_id)
+    if pending is not None and pending['state'] != 'creating':
+        st.rerun()
+    st.info("Preparing secure checkout...")
+
+def checkout_status(pending):
+    if pending['state'] != 'open':
+        # Settled; submitting the form again starts a new checkout
+        st.session_state.pop('checkout_idempotency', None)
+    if pending['state'] == 'open':
+        st.link_button("Pay with Stripe", pending['checkout_url'], use_container_width=True)
+        st.caption(f"Your pickup window is held for {payments.CHECKOUT_EXPIRES_SECONDS // 60} minutes while you pay.")
+    elif pending['state'] == 'failed':
+        st.error(f"An error occurred while processing your payment: {pending['error']}")
+    elif pending['state'] == 'paid':
+        st.success("Payment received! Your pickup has been scheduled.")
+    else:
+        st.warning("This checkout has expired. Please schedule your pickup again.")
+
+HISTORY_PAGE_SIZE = 20
+
+def _next_history_page(user_id, loaded_orders):
+    # Returns (page, has_more); safe to run off the script thread
+    after = None
+    if loaded_orders:
+        last = loaded_orders[-1]
+        after = (last[2], last[0])
+    # Fetch one extra row to learn whether another page exists
+    page = database.cached_user_read(database.fetch_user_orders_page, user_id, after, HISTORY_PAGE_SIZE + 1)
+    return page[:HISTORY_PAGE_SIZE], len(page) > HISTORY_PAGE_SIZE
+
+def load_more_orders():
+    state = st.session_state
+    page, state.history_has_more = _next_history_page(state.user['id'], state.history_orders)
+    state.history_orders.extend(page)
 
 def order_history():
     st.title("Wash & Go Delivery Order History 📋")
-    orders = database.fetch_all(
-        "SELECT * FROM orders WHERE user_id = %s ORDER BY pickup_date DESC",
-        (st.session_state.user['id'],)
-    )
+    state = st.session_state
+    user_id = state.user['id']
+    # Start again from the newest page when this customer's orders change or
+    # another user logs in
+    history_key = (user_id, database.user_orders_version(user_id))
+    if state.get('history_key') != history_key:
+        # The first page and both charts' aggregates are independent reads
+        (first_page, has_more), by_status, spending = database.call_concurrently([
+            lambda: _next_history_page(user_id, []),
+            lambda: database.cached_user_read(database.user_orders_by_status, user_id),
+            lambda: database.cached_user_read(database.user_spending_by_date, user_id),
+        ])
+        state.history_key = history_key
+        state.history_orders = first_page
+        state.history_has_more = has_more
+        state.history_stats = (by_status, spending)
     
-    if orders:
-        df_orders = pd.DataFrame(orders, columns=['id', 'user_id', 'pickup_date', 'pickup_time', 'location', 'status', 'weight', 'item_count', 'total_price'])
-        
+    if state.history_orders:
         # Display orders in an expandable format
-        for _, order in df_orders.iterrows():
-            with st.expander(f"Order #{order['id']} - {order['pickup_date']}"):
+        for order in state.history_orders:
+            order_id, _, pickup_date, pickup_time, location, status, weight, item_count, total_price = order
+            with st.expander(f"Order #{order_id} - {pickup_date}"):
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.write(f"Status: {order['status']}")
-                    st.write(f"Pickup Time: {order['pickup_time']}")
-                    st.write(f"Location: {order['location']}")
+                    st.write(f"Status: {status}")
+                    st.write(f"Pickup Time: {pickup_time}")
+                    st.write(f"Location: {location}")
                 with col2:
-                    st.write(f"Weight: {order['weight']} kg")
-                    st.write(f"Item Count: {order['item_count']}")
-                    st.write(f"Total Price: ${order['total_price']:.2f}")
+                    st.write(f"Weight: {weight} kg")
+                    st.write(f"Item Count: {item_count}")
+                    st.write(f"Total Price: ${total_price:.2f}")
+        
+        if state.history_has_more:
+            st.button("Load more orders", key='load_more_orders_button', on_click=load_more_orders, use_container_width=True)
         
         # Visualizations
         st.subheader("Order Statistics")
         
+        # Figures are cached per customer until their orders change
+        by_status, spending = state.history_stats
+        orders_version = state.history_key[1]
         col1, col2 = st.columns(2)
         
         with col1:
             # Orders by status
-            status_counts = df_orders['status'].value_counts()
-            fig_status = px.pie(values=status_counts.values, names=status_counts.index, title="Orders by Status")
+            fig_status = charts.cached_figure('user_orders_by_status', user_id, orders_version, lambda: px.pie(
+                by_status, values='count', names='status', title="Orders by Status"
+            ))
             st.plotly_chart(fig_status)
         
         with col2:
             # Total spent over time
-            df_orders['pickup_date'] = pd.to_datetime(df_orders['pickup_date'])
-            spending_over_time = df_orders.groupby('pickup_date')['total_price'].sum().reset_index()
-            fig_spending = px.line(spending_over_time, x='pickup_date', y='total_price', title="Total Spent Over Time")
+            fig_spending = charts.cached_figure('user_spending_by_date', user_id, orders_version, lambda: px.line(
+                spending, x='pickup_date', y='total_price', title="Total Spent Over Time"
+            ))
             st.plotly_chart(fig_spending)
     else:
         st.info("You don't have any orders with Wash & Go Delivery yet.")
 
 def handle_successful_payment():
     if 'session_id' in st.query_params:
-        session_id = st.query_params['session_id']
-        if 'pending_order' in st.session_state and st.session_state.pending_order['checkout_session_id'] == session_id:
-            order = st.session_state.pending_order
-            try:
-                database.execute_query(
-                    "INSERT INTO orders (user_id, pickup_date, pickup_time, location, weight, item_count, total_price, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                    (order['user_id'], order['pickup_date'], order['pickup_time'], order['location'], order['weight'], order['item_count'], order['total_price'], 'Paid')
-                )
-                if st.session_state.user['is_first_time_customer']:
-                    database.set_customer_order_placed(st.session_state.user['id'])
-                    st.session_state.user['is_first_time_customer'] = False
-                st.success("Payment successful! Your pickup has been scheduled.")
-                del st.session_state.pending_order
-            except Exception as e:
-                st.error(f"An error occurred while finalizing your order: {str(e)}")
-        else:
+        # Handle each return once; later reruns shouldn't ask Stripe again
+        checkout_session_id = st.query_params['session_id']
+        del st.query_params['session_id']
+        # Check with Stripe rather than trusting this browser session, so the
+        # order is recorded even if the session that started checkout is gone
+        try:
+            order = payments.confirm_checkout(checkout_session_id)
+        except Exception as e:
+            st.error(f"An error occurred while finalizing your order: {str(e)}")
+            return
+        if order is None:
             st.warning("Invalid or expired payment session.")
+            return
+        if st.session_state.user and st.session_state.user['id'] == order['user_id']:
+            st.session_state.user['is_first_time_customer'] = False
+        st.session_state.pop('checkout_pending_id', None)
+        st.session_state.pop('checkout_idempotency', None)
+        st.success("Payment successful! Your pickup has been scheduled.")
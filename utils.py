@@ -1,21 +1,109 @@
+import functools
+import re
+from datetime import date, datetime, time, timedelta
+from types import MappingProxyType
+import numpy as np
+
+# Service areas with approximate city-centre coordinates (latitude, longitude)
+SERVICE_AREAS = {
+    'Bethesda, MD': (38.9847, -77.0947),
+    'Rockville, MD': (39.0840, -77.1528),
+    'Silver Spring, MD': (38.9907, -77.0261),
+    'Washington, D.C.': (38.9072, -77.0369),
+    'Gaithersburg, MD': (39.1434, -77.2014),
+    'Colesville, MD': (39.0754, -77.0019),
+    'Laurel, MD': (39.0993, -76.8483),
+    'Hyattsville, MD': (38.9559, -76.9455),
+    'Chevy Chase, MD': (38.9829, -77.0761),
+    'Wheaton, MD': (39.0398, -77.0553),
+    'Takoma Park, MD': (38.9779, -77.0075),
+    'Greenbelt, MD': (39.0046, -76.8755),
+    'Riverdale Park, MD': (38.9634, -76.9319),
+    'Falls Church, VA': (38.8823, -77.1711),
+    'Alexandria, VA': (38.8048, -77.0469),
+    'Arlington, VA': (38.8816, -77.0910),
+    'Vienna, VA': (38.9012, -77.2653),
+    'Beltsville, MD': (39.0348, -76.9075),
+    'College Park, MD': (38.9807, -76.9369),
+    'Bladensburg, MD': (38.9393, -76.9339),
+    'Lanham, MD': (38.9687, -76.8633),
+    'Bowie, MD': (38.9426, -76.7302),
+    'Mount Rainier, MD': (38.9415, -76.9647),
+}
+
+# Matches the city part of a service area anywhere in a free-text address
+SERVICE_AREA_PATTERN = '(' + '|'.join(re.escape(area.split(',')[0]) for area in SERVICE_AREAS) + ')'
+
+PICKUP_WINDOW_MINUTES = 60
+
+def pickup_windows(day):
+    # Start times of the pickup windows offered on a day, within opening hours
+    # (Mon-Sat 7AM-9PM, Sun 9AM-7PM)
+    first, last = (9, 19) if day.weekday() == 6 else (7, 21)
+    return [time(hour) for hour in range(first, last)]
+
+def format_pickup_window(window_start):
+    end = (datetime.combine(date.min, window_start) + timedelta(minutes=PICKUP_WINDOW_MINUTES)).time()
+    return f"{window_start:%I:%M %p} - {end:%I:%M %p}".replace(" 0", " ").lstrip("0")
+
+# Price tables by version. Add a new version instead of editing an old one so
+# past orders can still be re-quoted at the prices they were sold at.
+PRICE_TABLES = {
+    1: {
+        'base_price': 0.00,
+        'price_per_kg': 4.19,  # $1.90 per pound is approximately $4.19 per kg
+        'minimum_charge': 38.00,  # 20-pound minimum
+        'first_time_discount': 0.20,
+        'blanket_price': 15.00,
+        'pillow_price': 7.00,
+    },
+}
+CURRENT_PRICE_VERSION = max(PRICE_TABLES)
+
+@functools.lru_cache(maxsize=None)
+def price_table(version=None):
+    # Read-only view of one price table version, the current one by default
+    version = CURRENT_PRICE_VERSION if version is None else version
+    if version not in PRICE_TABLES:
+        raise ValueError(f"Unknown price table version: {version}")
+    return MappingProxyType(PRICE_TABLES[version])
+
 def calculate_price_by_weight(weight, is_first_time_customer=False):
-    base_price = 0.00
-    price_per_kg = 4.19  # $1.90 per pound is approximately $4.19 per kg
-    total_price = base_price + (weight * price_per_kg)
-    minimum_charge = 38.00  # 20-pound minimum
-    total_price = max(total_price, minimum_charge)
+    prices = price_table()
+    total_price = prices['base_price'] + (weight * prices['price_per_kg'])
+    total_price = max(total_price, prices['minimum_charge'])
     
     if is_first_time_customer:
-        total_price *= 0.8  # Apply 20% discount for first-time customers
+        total_price *= 1 - prices['first_time_discount']
     
     return total_price
 
 def calculate_price_for_special_items(blankets=0, pillows=0):
-    blanket_price = 15.00
-    pillow_price = 7.00
-    return (blankets * blanket_price) + (pillows * pillow_price)
+    prices = price_table()
+    return (blankets * prices['blanket_price']) + (pillows * prices['pillow_price'])
 
 def calculate_total_price(weight, blankets=0, pillows=0, is_first_time_customer=False):
     weight_price = calculate_price_by_weight(weight, is_first_time_customer)
     special_items_price = calculate_price_for_special_items(blankets, pillows)
     return weight_price + special_items_price
+
+# Batch versions of the functions above. Arguments may be arrays or scalars
+# and broadcast against each other, so a whole order set is priced in one pass.
+
+def calculate_prices_by_weight(weights, is_first_time_customer=False, version=None):
+    prices = price_table(version)
+    weights = np.asarray(weights, dtype=np.float64)
+    total_prices = np.maximum(prices['base_price'] + weights * prices['price_per_kg'], prices['minimum_charge'])
+    return np.where(is_first_time_customer, total_prices * (1 - prices['first_time_discount']), total_prices)
+
+def calculate_prices_for_special_items(blankets=0, pillows=0, version=None):
+    prices = price_table(version)
+    return np.asarray(blankets, dtype=np.float64) * prices['blanket_price'] + np.asarray(pillows, dtype=np.float64) * prices['pillow_price']
+
+def calculate_total_prices(weights, blankets=0, pillows=0, is_first_time_customer=False, version=None):
+    return (calculate_prices_by_weight(weights, is_first_time_customer, version)
+            + calculate_prices_for_special_items(blankets, pillows, version))
+
+def first_time_discounts(weights, version=None):
+    # What the first-time discount took off each weight-priced order
+    return calculate_prices_by_weight(weights, False, version) - calculate_prices_by_weight(weights, True, version)